@@ -1,31 +1,70 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template, request
 import threading
 import asyncio
 import websockets
 import socket
 import json
+import struct
 import uuid
 import random
 import time
+import zlib
+import argparse
+import bisect
+import gzip
+import hashlib
+import http
+import os
+import multiprocessing
+import queue
+import sys
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+from werkzeug.test import EnvironBuilder
+from websockets.datastructures import Headers
+from websockets.http11 import Response as WsResponse
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    # bots then plan one at a time in plain Python, see plan_bots()
+    np = None
 
 app = Flask(__name__)
+# served by the workers too in sharded mode, for the router to merge
+WS_STATS_PATH = '/api/ws-stats'
+
+
+def ws_base():
+    # where the pages should open their WebSocket: the page's own host and
+    # port in single-port mode, else the same host on the game port. A page
+    # served over https (here or at a TLS-terminating proxy that sets
+    # X-Forwarded-Proto) gets wss://, since browsers block ws:// from it.
+    proto = request.headers.get('X-Forwarded-Proto', request.scheme).split(',')[0].strip()
+    scheme = 'wss' if proto == 'https' else 'ws'
+    if single_port:
+        return f"{scheme}://{request.host}"
+    host = request.host if request.host.endswith(']') else request.host.rsplit(':', 1)[0]
+    return f"{scheme}://{host}:{websocket_port or 6789}"
 
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', echo_url=ws_base() + ECHO_PATH)
 
 
 @app.route('/game')
 def game():
-    return render_template('game.html')
+    return render_template('game.html', echo_url=ws_base() + ECHO_PATH)
 
 
 @app.route('/snake')
 @app.route('/snakes')
 def snake_page():
-    host = f"ws://localhost:{websocket_port or 6789}"
-    return render_template('snake.html', websocket_host=host)
+    return render_template('snake.html', websocket_host=ws_base(), fixed_host=single_port)
 
 
 @app.route('/api/data', methods=['GET'])
@@ -35,167 +74,2191 @@ def get_data():
 
 @app.route('/ws-port', methods=['GET'])
 def ws_port():
+    # with ?room=, the port (and --worker-url) of the worker that owns it,
+    # which saves the page a redirect in sharded mode
+    room = request.args.get('room')
+    if room and worker_ports:
+        message = redirect_message(room)
+        return jsonify({key: message[key] for key in ('port', 'url') if key in message})
     return jsonify({'port': websocket_port})
 
 
+@app.route(WS_STATS_PATH, methods=['GET'])
+def get_ws_stats():
+    return jsonify(ws_stats)
+
+
+@app.route('/api/rooms/<name>/log', methods=['GET'])
+def get_room_log(name):
+    # the room's match log, for snake_replay.py
+    room_info = rooms.get(name)
+    if room_info is None:
+        return jsonify({'error': 'no such room'}), 404
+    return Response(room_log(room_info), mimetype='application/octet-stream')
+
+
+@app.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    # the snapshot stats_loop() last published, so polling never waits on
+    # (or even looks at) the rooms
+    cached = leaderboard_cache
+    headers = {'ETag': cached['etag'], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if cached['etag'] in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return Response(cached['gzip'], mimetype='application/json', headers=headers)
+    return Response(cached['body'], mimetype='application/json', headers=headers)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # rendered from the ws_stats snapshot, never from the live asyncio state
+    return Response(render_metrics(ws_stats), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 clients = {}
 players = {}
 rooms = {}
+# resume token (sent in 'welcome') -> pid, see resume_session()
+sessions = {}
+# guards the players/clients registries on connect and disconnect only; each
+# room has its own lock for everything that happens inside it
 state_lock = asyncio.Lock()
+# websocket -> outbox, see open_outbox()
+outboxes = {}
+# running totals for the outboxes; ws_stats is a copy republished every tick
+# so other threads can read it without touching the asyncio side
+outbox_counters = {'frames_dropped': 0, 'send_failures': 0, 'slow_disconnects': 0}
+# messages read from and bytes written to game sockets since startup
+traffic_counters = {'messages_in': 0, 'bytes_out': 0}
+# totals at the previous publish_stats(), for the per-second rates
+traffic_last = {'at': None, 'messages_in': 0, 'bytes_out': 0}
+# rooms dropped by evict_rooms() since startup
+room_counters = {'evicted': 0}
+# players picked back up by resume_session() and dropped by
+# expire_sessions() since startup
+session_counters = {'resumed': 0, 'expired': 0}
+ws_stats = {}
+
+# millisecond bucket bounds for the tick histograms; the last bucket is open
+TICK_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 150, 250, 500, 1000)
+
+
+def new_histogram(bounds=TICK_BUCKETS_MS):
+    return {'bounds': bounds, 'counts': [0] * (len(bounds) + 1), 'sum': 0.0, 'count': 0}
+
+
+def observe(hist, value):
+    hist['counts'][bisect.bisect_left(hist['bounds'], value)] += 1
+    hist['sum'] += value
+    hist['count'] += 1
+
+
+# how much later than asked stats_loop's sleeps wake up, i.e. how long
+# callbacks wait for the event loop
+loop_stats = {'lag_ms': new_histogram(), 'last_lag_ms': 0.0}
+# websocket -> {'hist', 'last'}: RTT histogram of each latency connection,
+# fed by probe_rtt()
+rtt_probes = {}
+# processing time and start lateness of every room tick, in ms
+tick_stats = {
+    'duration_ms': new_histogram(),
+    'lateness_ms': new_histogram(),
+    'overruns': 0,
+    'skipped': 0,
+}
+
+# Event log. log_event() counts every event and, if the event's level and
+# sample rate let it through, hands the record to a background thread that
+# formats it and does the blocking write to stdout, so the event loop never
+# waits on the terminal. LOG_EVENTS maps each event type to its level and
+# the fraction of records written; unknown events are info and always written.
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_EVENTS = {
+    'CONNECT': ('info', 1.0),
+    'CLOSE': ('info', 1.0),
+    'JOIN': ('info', 1.0),
+    'START': ('info', 1.0),
+    'SPECTATE': ('info', 1.0),
+    'RESUME': ('info', 1.0),
+    'BOTS': ('info', 1.0),
+    'REDIRECT': ('info', 1.0),
+    # one per key press, so only ever sampled, and only at debug level
+    'DIR': ('debug', 0.05),
+    'BAD_JSON': ('warning', 1.0),
+    'HANDLER_ERROR': ('error', 1.0),
+    'LEADERBOARD_ERROR': ('error', 1.0),
+    'STATS_ERROR': ('error', 1.0),
+    'LOOP_ERROR': ('error', 1.0),
+}
+LOG_QUEUE_SIZE = 10000
+log_level = LOG_LEVELS['info']
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_writer = None
+# event -> times seen, written or not; 'dropped' counts records lost to a
+# full queue
+event_counts = {}
+log_counters = {'dropped': 0}
+
+
+def log_event(component, event, **fields):
+    event_counts[event] = event_counts.get(event, 0) + 1
+    level, rate = LOG_EVENTS.get(event, ('info', 1.0))
+    if LOG_LEVELS[level] < log_level or (rate < 1.0 and random.random() >= rate):
+        return
+    if log_writer is None:
+        start_log_writer()
+    try:
+        log_queue.put_nowait((time.time(), level, component, event, fields))
+    except queue.Full:
+        log_counters['dropped'] += 1
+
+
+def format_log_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="'):
+        return json.dumps(text)
+    return text
+
+
+def format_log_record(record):
+    ts, level, component, event, fields = record
+    stamp = time.strftime('%H:%M:%S', time.localtime(ts)) + f'.{int(ts % 1 * 1000):03d}'
+    parts = [stamp, level.upper(), f'[{component}]', event]
+    parts.extend(f'{key}={format_log_value(value)}' for key, value in fields.items())
+    return ' '.join(parts)
+
+
+def log_writer_loop():
+    while True:
+        lines = [format_log_record(log_queue.get())]
+        # drain whatever else queued up meanwhile so a burst is one write
+        while True:
+            try:
+                lines.append(format_log_record(log_queue.get_nowait()))
+            except queue.Empty:
+                break
+        try:
+            sys.stdout.write('\n'.join(lines) + '\n')
+            sys.stdout.flush()
+        except Exception:
+            pass
+
+
+def start_log_writer():
+    global log_writer
+    log_writer = threading.Thread(target=log_writer_loop, name='log-writer', daemon=True)
+    log_writer.start()
+
 
 websocket_port = None
+# True when start_servers(single_port=True) serves the pages and the game
+# socket together from the asyncio side on one port
+single_port = False
 
+# default board; a room can be started on its own size ('start' with w/h)
 GRID_W = 28
 GRID_H = 20
+MIN_GRID = 10
+MAX_GRID = 1000
 CELL_SIZE = 18
 TICK = 0.15
+MIN_TICK = 0.05
+MAX_TICK = 1.0
+# turns a player can queue ahead of the tick; further turns push out the oldest
+INPUT_QUEUE = 3
+DIRECTIONS = {'up': [0, -1], 'down': [0, 1], 'left': [-1, 0], 'right': [1, 0]}
+# a room that falls behind runs up to this many ticks back to back to catch
+# up; beyond that the missed ticks are skipped and the schedule restarts
+MAX_CATCHUP_TICKS = 2
+KEYFRAME_TICKS = 20
+OUTBOX_SIZE = 4
+# clients that offer this subprotocol get the struct-packed frames built by
+# encode_keyframe_bin/encode_delta_bin; everyone else keeps getting JSON
+BINARY_SUBPROTOCOL = 'snake.bin.v2'
+JSON_SUBPROTOCOL = 'snake.json'
+SLOW_CLIENT_TIMEOUT = 5.0
+# the latency pages (index.html, game.html) connect here; everything sent on
+# this path is echoed straight back
+ECHO_PATH = '/echo'
+RTT_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+# how often an echo connection gets a protocol ping to measure its RTT
+RTT_PROBE_EVERY = 1.0
+# the RTT samples of latency connections that have closed, folded in by
+# close_rtt_probe() so the exported histogram never goes down
+rtt_closed = new_histogram(RTT_BUCKETS_MS)
+# keyframes per second for spectators (?role=spectator&hz=N), see
+# spectator_loop()
+SPECTATOR_HZ = 4
+MIN_SPECTATOR_HZ = 0.5
+MAX_SPECTATOR_HZ = 10
+# spectator sockets written per event loop step, and the unsent bytes at
+# which a spectator skips a keyframe instead of buffering it
+SPECTATOR_BATCH = 500
+SPECTATOR_BACKLOG = 64 * 1024
+# A game socket that drops without a 'leave' message leaves its player (and
+# snake, and score) in the room for RESUME_GRACE seconds. Reconnecting with
+# ?resume=<token from the welcome> within that picks the same player back
+# up and gets one keyframe instead of joining from scratch.
+RESUME_GRACE = 15.0
+# seconds an empty room stays hibernated (state and match log kept, no task)
+# before evict_rooms() drops it
+ROOM_TTL = 60.0
+# A board bigger than VIEW_W x VIEW_H is too big to send whole every tick.
+# Its snakes and food are indexed in buckets of 2**BUCKET_SHIFT cells a
+# side, and each player only gets what lies in the buckets within
+# VIEW_MARGIN cells of a view centred on their head (see view_frame()).
+# Players can ask for another view size with a 'view' message.
+VIEW_W = 48
+VIEW_H = 32
+MAX_VIEW_W = 128
+MAX_VIEW_H = 96
+VIEW_MARGIN = 8
+BUCKET_SHIFT = 4
+# a running board keeps 3 food, or one per FOOD_AREA cells on big boards
+FOOD_AREA = 1000
+# Server-side bots ('bots' message, see plan_bots()). Each tick every bot
+# searches the cells within BOT_SIGHT of its head, breadth first for at
+# most BOT_STEPS steps, from each of its possible next cells. It takes the
+# move with the nearest food among those that still reach enough free
+# cells to hold its body, or failing that the one that reaches the most.
+# A dead bot respawns after BOT_RESPAWN_TICKS. Without NumPy the planner
+# takes about 2 ms a bot on the event loop every room shares, so a room
+# gets at most MAX_BOTS_PYTHON bots then.
+MAX_BOTS = 200
+MAX_BOTS_PYTHON = 10
+BOT_SIGHT = 10
+BOT_STEPS = 4 * BOT_SIGHT
+BOT_RESPAWN_TICKS = 10
+# distance reported when no food was found
+BOT_BLIND = BOT_STEPS + 1
+
+
+def new_room(seed=None, w=None, h=None):
+    # 'w' and 'h' are the board size, set along with the cell indexes below
+    # by set_grid(). 'cells' maps a packed cell index (y * w + x) to the pid
+    # whose snake occupies it and
+    # 'food_cells' holds the packed indices of the food, so every collision
+    # check in the tick is a single lookup instead of a scan of every snake.
+    # 'members' (pid -> player) and 'sockets' (websocket -> pid) index who is
+    # in the room so ticking and broadcasting never walk the global dicts.
+    # 'delta' collects what changed since the last frame; sockets listed in
+    # 'need_key' get a full keyframe on the next broadcast instead.
+    # 'audience' holds the spectator sockets grouped by frame rate and wire
+    # format (hz -> format -> set of websockets); they have no player and
+    # no cells, and each rate is served by its task in 'spectator_tasks'.
+    # Everything random in the room comes from its own 'rng', and whatever
+    # else changes the simulation is appended to 'log' (see the match log
+    # below), so a room can be replayed tick for tick.
+    # 'idle_since' is when the room last had no room_loop task (it starts
+    # out hibernated); None while the task runs.
+    # 'views' (websocket -> view) is what each socket of a bucketed room has
+    # been sent, see view_frame().
+    # 'bots' (pid -> player) are the members the server steers itself.
+    if seed is None:
+        seed = random.getrandbits(63)
+    w = w or GRID_W
+    h = h or GRID_H
+    room_info = {
+        'running': False,
+        'members': {},
+        'sockets': {},
+        'views': {},
+        'audience': {},
+        'spectator_tasks': {},
+        'bots': {},
+        'tick': 0,
+        # server_ms() when the current frame was sent
+        'sent_ms': 0,
+        'delta': new_delta(),
+        'need_key': set(),
+        'force_key': False,
+        'slots': {},
+        'free_slots': [],
+        'next_slot': 0,
+        'lock': asyncio.Lock(),
+        'wake': asyncio.Event(),
+        'interval': TICK,
+        'task': None,
+        'idle_since': time.monotonic(),
+        'last_tick_ms': 0.0,
+        'bot_ms': 0.0,
+        'overruns': 0,
+        'rng': random.Random(seed),
+        'log': new_match_log(seed, w, h),
+        'log_ids': {},
+    }
+    set_grid(room_info, w, h)
+    return room_info
+
+
+def get_room(room_name):
+    # new_room() builds a whole grid, so it only runs for a room that
+    # isn't there yet
+    room_info = rooms.get(room_name)
+    if room_info is None:
+        room_info = rooms[room_name] = new_room()
+    return room_info
+
+
+def set_grid(room_info, w, h):
+    # (Re)sets the board to an empty w x h. Boards that don't fit in one
+    # view also get the spatial buckets: 'snake_buckets' maps a bucket to
+    # {pid: cells of that snake in it}, 'food_buckets' a bucket to the
+    # packed food cells in it. Both stay None on small boards.
+    room_info['w'] = w
+    room_info['h'] = h
+    room_info['food'] = []
+    room_info['cells'] = {}
+    room_info['food_cells'] = set()
+    room_info['free'] = new_free_cells(w, h)
+    bucketed = w > VIEW_W or h > VIEW_H
+    room_info['bucket_cols'] = ((w - 1) >> BUCKET_SHIFT) + 1
+    room_info['snake_buckets'] = {} if bucketed else None
+    room_info['food_buckets'] = {} if bucketed else None
+
+
+def grid_size(w, h):
+    # the board size asked for by a 'start' message, or None to keep it
+    if not isinstance(w, int) or not isinstance(h, int):
+        return None
+    return min(MAX_GRID, max(MIN_GRID, w)), min(MAX_GRID, max(MIN_GRID, h))
+
+
+def new_delta():
+    return {
+        'join': {},
+        'leave': [],
+        'upd': {},
+        'heads': {},
+        'tails': {},
+        'food_del': [],
+        'food_add': [],
+    }
+
+
+def mark_update(room_info, pid, **fields):
+    room_info['delta']['upd'].setdefault(pid, {}).update(fields)
+
+
+def server_ms():
+    # the 'time' of every frame: a millisecond clock that wraps at 2**32,
+    # only ever compared between frames
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+
+def cell_index(x, y, w):
+    return y * w + x
+
+
+def new_free_cells(w, h):
+    # The interior cells (where food may spawn) holding neither a snake nor
+    # food, as a swap-remove array: the first 'size' entries of 'cells' are
+    # the free cell indices and 'pos' maps a cell index to its entry, or -1
+    # when the cell is taken. Taking, releasing and sampling are all O(1).
+    # The memoryview casts store both at four bytes per cell. Filled a row
+    # at a time, in the order free_put() would, so a 1000x1000 board
+    # doesn't take a million calls.
+    total = w * h
+    cells = bytearray(4 * total)
+    pos = bytearray(b'\xff') * (4 * total)
+    size = 0
+    inner = w - 2
+    if inner > 0:
+        row = struct.Struct(f'={inner}i')
+        for y in range(1, h - 1):
+            start = y * w + 1
+            cells[4 * size:4 * (size + inner)] = row.pack(*range(start, start + inner))
+            pos[4 * start:4 * (start + inner)] = row.pack(*range(size, size + inner))
+            size += inner
+    return {'cells': memoryview(cells).cast('i'), 'pos': memoryview(pos).cast('i'), 'size': size, 'w': w, 'h': h}
+
+
+def free_take(free, idx):
+    pos = free['pos']
+    slot = pos[idx]
+    if slot < 0:
+        return
+    cells = free['cells']
+    last = cells[free['size'] - 1]
+    cells[slot] = last
+    pos[last] = slot
+    pos[idx] = -1
+    free['size'] -= 1
+
+
+def free_put(free, idx):
+    pos = free['pos']
+    if pos[idx] >= 0:
+        return
+    w, h = free['w'], free['h']
+    x, y = idx % w, idx // w
+    if x < 1 or x > w - 2 or y < 1 or y > h - 2:
+        return
+    pos[idx] = free['size']
+    free['cells'][free['size']] = idx
+    free['size'] += 1
+
+
+# A snake's body is a ring buffer of packed cell indices, head first: 'buf'
+# is an int32 memoryview that doubles when full, 'head' is the slot of the
+# head and 'len' the number of cells. Pushing a head and popping the tail
+# are O(1) and cost four bytes per cell.
+def new_body(cells=()):
+    body = {'buf': memoryview(bytearray(4 * 8)).cast('i'), 'head': 0, 'len': 0}
+    for idx in reversed(list(cells)):
+        body_push(body, idx)
+    return body
+
+
+def spawn_body(room_info, rng=None):
+    # near the top left corner, heading right; on big boards the corner
+    # grows to a quarter of the board so snakes don't all start together.
+    # Only start_room() draws from the room's rng: other spawns are recorded
+    # cell by cell in LOG_JOIN, so they pass their own.
+    rng = rng or room_info['rng']
+    x = rng.randrange(4, max(8, room_info['w'] // 4))
+    y = rng.randrange(4, max(8, room_info['h'] // 4))
+    return new_body([cell_index(x, y, room_info['w'])])
+
+
+def body_push(body, idx):
+    buf = body['buf']
+    cap = len(buf)
+    if body['len'] == cap:
+        grown = memoryview(bytearray(8 * cap)).cast('i')
+        head = body['head']
+        grown[:cap - head] = buf[head:]
+        grown[cap - head:cap] = buf[:head]
+        body['buf'] = buf = grown
+        body['head'] = 0
+        cap *= 2
+    head = (body['head'] - 1) % cap
+    buf[head] = idx
+    body['head'] = head
+    body['len'] += 1
+
+
+def body_pop(body):
+    buf = body['buf']
+    body['len'] -= 1
+    return buf[(body['head'] + body['len']) % len(buf)]
+
+
+def body_head(body):
+    return body['buf'][body['head']]
+
+
+def body_cells(body):
+    buf, head, end = body['buf'], body['head'], body['head'] + body['len']
+    if end <= len(buf):
+        return buf[head:end].tolist()
+    return buf[head:].tolist() + buf[:end - len(buf)].tolist()
+
+
+def queue_input(p, d):
+    # Called straight from the socket handler without any lock. The room
+    # applies one queued turn per tick at the start of step_room, so two
+    # quick turns land on consecutive ticks instead of the second one
+    # overwriting the first. Repeats of the direction the snake will
+    # already be heading in (e.g. a held D-pad) are dropped.
+    vec = DIRECTIONS.get(d)
+    if vec is None:
+        return
+    inputs = p['inputs']
+    if vec != (inputs[-1] if inputs else p['dir']):
+        inputs.append(vec)
+
+
+def player_state(p, w):
+    # the JSON shape clients have always received, with the body unpacked
+    # back into [x, y] pairs
+    return {
+        'id': p['id'],
+        'name': p['name'],
+        'snake': [[idx % w, idx // w] for idx in body_cells(p['body'])],
+        'dir': p['dir'],
+        'alive': p['alive'],
+        'score': p['score'],
+        'color': p['color'],
+        'room': p['room'],
+    }
+
+
+def bucket_of(room_info, idx):
+    w = room_info['w']
+    return ((idx // w) >> BUCKET_SHIFT) * room_info['bucket_cols'] + ((idx % w) >> BUCKET_SHIFT)
+
+
+def bucket_add(buckets, b, pid):
+    owners = buckets.get(b)
+    if owners is None:
+        owners = buckets[b] = {}
+    owners[pid] = owners.get(pid, 0) + 1
+
+
+def bucket_drop(buckets, b, pid):
+    owners = buckets[b]
+    if owners[pid] > 1:
+        owners[pid] -= 1
+        return
+    del owners[pid]
+    if not owners:
+        del buckets[b]
+
+
+def occupy_snake(room_info, pid, body):
+    cells = room_info['cells']
+    free = room_info['free']
+    buckets = room_info['snake_buckets']
+    for idx in body_cells(body):
+        cells[idx] = pid
+        free_take(free, idx)
+        if buckets is not None:
+            bucket_add(buckets, bucket_of(room_info, idx), pid)
+
+
+def release_snake(room_info, pid, body):
+    cells = room_info['cells']
+    free = room_info['free']
+    buckets = room_info['snake_buckets']
+    for idx in body_cells(body):
+        if cells.get(idx) == pid:
+            del cells[idx]
+            if idx not in room_info['food_cells']:
+                free_put(free, idx)
+        if buckets is not None:
+            bucket_drop(buckets, bucket_of(room_info, idx), pid)
+
+
+def attach_socket(room_info, pid, websocket):
+    # the socket's first frame from this room is a keyframe
+    room_info['sockets'][websocket] = pid
+    room_info['views'][websocket] = new_view()
+    room_info['need_key'].add(websocket)
+
+
+def detach_socket(room_info, websocket):
+    room_info['sockets'].pop(websocket, None)
+    room_info['views'].pop(websocket, None)
+    room_info['need_key'].discard(websocket)
+
+
+def enter_room(pid, room_name, websocket=None):
+    p = players[pid]
+    room_info = get_room(room_name)
+    p['room'] = room_name
+    room_info['members'][pid] = p
+    room_info['delta']['join'][pid] = p
+    if pid not in room_info['slots']:
+        if room_info['free_slots']:
+            room_info['slots'][pid] = room_info['free_slots'].pop()
+        else:
+            room_info['slots'][pid] = room_info['next_slot']
+            room_info['next_slot'] += 1
+    if websocket is not None:
+        attach_socket(room_info, pid, websocket)
+    occupy_snake(room_info, pid, p['body'])
+    log_join(room_info, pid, p)
+    return room_info
+
+
+def leave_room(pid, websocket=None):
+    p = players.get(pid)
+    room_info = rooms.get(p.get('room')) if p else None
+    if room_info is None:
+        return
+    room_info['members'].pop(pid, None)
+    delta = room_info['delta']
+    if delta['join'].pop(pid, None) is None:
+        delta['leave'].append(pid)
+    if websocket is not None:
+        detach_socket(room_info, websocket)
+    release_snake(room_info, pid, p['body'])
+    log_record(room_info, LOG_LEAVE, pid)
+
+
+def watch_room(websocket, room_name, hz):
+    room_info = get_room(room_name)
+    fmt = wire_format(websocket)
+    room_info['audience'].setdefault(hz, {}).setdefault(fmt, set()).add(websocket)
+    if hz not in room_info['spectator_tasks']:
+        room_info['spectator_tasks'][hz] = asyncio.create_task(spectator_loop(room_name, room_info, hz))
+    # something to show right away instead of at the rate's next frame
+    box = outboxes.get(websocket)
+    if box is not None:
+        queue_frame(websocket, spectator_frame(room_name, room_info, box['format']))
+    return room_info
+
+
+def unwatch_room(websocket, room_name, hz):
+    room_info = rooms.get(room_name)
+    if room_info is None:
+        return
+    formats = room_info['audience'].get(hz, {})
+    fmt = wire_format(websocket)
+    watchers = formats.get(fmt)
+    if watchers is not None:
+        watchers.discard(websocket)
+        if not watchers:
+            del formats[fmt]
+            if not formats:
+                del room_info['audience'][hz]
+                room_info['spectator_tasks'].pop(hz).cancel()
+    if room_is_empty(room_info):
+        if room_info['idle_since'] is None:
+            # the room's task may be parked in room_loop's idle wait; let
+            # it see the room is empty and hibernate
+            room_info['wake'].set()
+        else:
+            # spectators don't wake the room, so its TTL restarts from here
+            room_info['idle_since'] = time.monotonic()
+
+
+async def spectator_loop(room_name, room_info, hz):
+    # Spectators stay out of the tick: every 1/hz seconds, if the room has
+    # ticked since the last time, this writes one keyframe per wire format
+    # straight to the transports of all the rate's sockets with
+    # websockets.broadcast(), SPECTATOR_BATCH sockets per loop step so a
+    # big audience doesn't hold up the rooms' ticks. A spectator too far
+    # behind to take the frame skips it; the next one replaces it anyway.
+    sent_tick = None
+    while True:
+        await asyncio.sleep(1 / hz)
+        if room_info['tick'] != sent_tick:
+            sent_tick = room_info['tick']
+            await push_spectators(room_name, room_info, hz)
+
+
+async def push_spectators(room_name, room_info, hz):
+    for fmt, watchers in list(room_info['audience'].get(hz, {}).items()):
+        data = spectator_frame(room_name, room_info, fmt)
+        watchers = list(watchers)
+        for i in range(0, len(watchers), SPECTATOR_BATCH):
+            chunk = watchers[i:i + SPECTATOR_BATCH]
+            batch = [ws for ws in chunk if ws.transport.get_write_buffer_size() < SPECTATOR_BACKLOG]
+            outbox_counters['frames_dropped'] += len(chunk) - len(batch)
+            websockets.broadcast(batch, data)
+            traffic_counters['bytes_out'] += len(data) * len(batch)
+            await asyncio.sleep(0)
+
+
+def spectator_hz(value, default=SPECTATOR_HZ):
+    try:
+        hz = float(value)
+    except (TypeError, ValueError):
+        return default
+    if hz != hz:
+        return default
+    return min(MAX_SPECTATOR_HZ, max(MIN_SPECTATOR_HZ, hz))
+
+
+def add_food(room_info, cell):
+    idx = cell_index(cell[0], cell[1], room_info['w'])
+    room_info['food'].append(cell)
+    room_info['food_cells'].add(idx)
+    if room_info['food_buckets'] is not None:
+        room_info['food_buckets'].setdefault(bucket_of(room_info, idx), set()).add(idx)
+    free_take(room_info['free'], idx)
+    room_info['delta']['food_add'].append(cell)
+
+
+def remove_food(room_info, x, y):
+    # only called when a head lands on the food, so the cell stays taken
+    idx = cell_index(x, y, room_info['w'])
+    room_info['food_cells'].discard(idx)
+    food_buckets = room_info['food_buckets']
+    if food_buckets is not None:
+        b = bucket_of(room_info, idx)
+        food_buckets[b].discard(idx)
+        if not food_buckets[b]:
+            del food_buckets[b]
+    room_info['food'] = [f for f in room_info['food'] if f[0] != x or f[1] != y]
+    delta = room_info['delta']
+    added = [f for f in delta['food_add'] if f[0] != x or f[1] != y]
+    if len(added) != len(delta['food_add']):
+        # spawned and eaten within the same frame: the client never saw it
+        delta['food_add'] = added
+    else:
+        delta['food_del'].append([x, y])
 
 
 def random_empty_cell(room=None):
-    for _ in range(200):
-        x = random.randrange(1, GRID_W - 1)
-        y = random.randrange(1, GRID_H - 1)
-        occupied = False
-        for p in players.values():
-            if room is not None and p.get('room') != room:
-                continue
-            for sx, sy in p.get('snake', []):
-                if sx == x and sy == y:
-                    occupied = True
-                    break
-            if occupied:
-                break
-        if occupied:
-            continue
-        if room and room in rooms:
-            clash = any(f[0] == x and f[1] == y for f in rooms[room].get('food', []))
-            if clash:
+    room_info = rooms.get(room) if room else None
+    if room_info is None:
+        return [random.randrange(1, GRID_W - 1), random.randrange(1, GRID_H - 1)]
+    free = room_info['free']
+    if not free['size']:
+        return None
+    idx = free['cells'][room_info['rng'].randrange(free['size'])]
+    return [idx % room_info['w'], idx // room_info['w']]
+
+
+def new_view():
+    # what one socket of a bucketed room has been sent: the pids of the
+    # snakes it holds and the packed cells of the food it holds
+    return {'pids': set(), 'food': set()}
+
+
+def view_size(w, h):
+    try:
+        w, h = int(w), int(h)
+    except (TypeError, ValueError):
+        return VIEW_W, VIEW_H
+    return min(MAX_VIEW_W, max(1, w)), min(MAX_VIEW_H, max(1, h))
+
+
+def interest(room_info, center, size):
+    # pids and food cells in every bucket touching the view (plus margin)
+    # centred on the packed cell `center`
+    w, h = room_info['w'], room_info['h']
+    cx, cy = center % w, center // w
+    half_w = size[0] // 2 + VIEW_MARGIN
+    half_h = size[1] // 2 + VIEW_MARGIN
+    bx0 = max(0, cx - half_w) >> BUCKET_SHIFT
+    bx1 = min(w - 1, cx + half_w) >> BUCKET_SHIFT
+    by0 = max(0, cy - half_h) >> BUCKET_SHIFT
+    by1 = min(h - 1, cy + half_h) >> BUCKET_SHIFT
+    cols = room_info['bucket_cols']
+    snake_buckets = room_info['snake_buckets']
+    food_buckets = room_info['food_buckets']
+    pids = set()
+    food = set()
+    for by in range(by0, by1 + 1):
+        for b in range(by * cols + bx0, by * cols + bx1 + 1):
+            owners = snake_buckets.get(b)
+            if owners:
+                pids.update(owners)
+            cells = food_buckets.get(b)
+            if cells:
+                food |= cells
+    return pids, food
+
+
+def view_frame(room_info, kind, center, size, view, pid=None):
+    # A stand-in for room_info, in the shape ENCODERS take, holding only
+    # what interest() finds around `center`. Snakes are sent whole once any
+    # part of them is in view. A delta is worked out against `view`, what
+    # the socket holds from earlier frames, which is then brought up to
+    # date; the socket's own snake is always in it.
+    w = room_info['w']
+    pids, food = interest(room_info, center, size)
+    if pid is not None:
+        pids.add(pid)
+    members = room_info['members']
+    info = {key: room_info[key] for key in ('tick', 'sent_ms', 'running', 'w', 'h', 'slots')}
+    if kind == 'key':
+        info['members'] = {q: members[q] for q in pids}
+        info['food'] = [[idx % w, idx // w] for idx in food]
+    else:
+        delta = room_info['delta']
+        known = view['pids']
+        out = new_delta()
+        # a pid that left and came back within the frame goes out as a leave
+        # and a join, like it does in the room's own delta
+        out['leave'] = [q for q in known if q not in pids or q in delta['join']]
+        for q in pids:
+            if q not in known or q in delta['join']:
+                out['join'][q] = members[q]
                 continue
-        return [x, y]
-    return [random.randrange(1, GRID_W - 1), random.randrange(1, GRID_H - 1)]
+            if q in delta['upd']:
+                out['upd'][q] = delta['upd'][q]
+            if q in delta['heads']:
+                out['heads'][q] = delta['heads'][q]
+            if q in delta['tails']:
+                out['tails'][q] = delta['tails'][q]
+        out['food_del'] = [[idx % w, idx // w] for idx in view['food'] - food]
+        out['food_add'] = [[idx % w, idx // w] for idx in food - view['food']]
+        info['delta'] = out
+    view['pids'] = pids
+    view['food'] = food
+    return info
+
 
+def spectator_frame(room_name, room_info, fmt):
+    # Spectators of a bucketed room share one view, following the best
+    # living snake (or the middle of the board).
+    if room_info['snake_buckets'] is None:
+        return ENCODERS[('key', fmt)](room_name, room_info)
+    w, h = room_info['w'], room_info['h']
+    best = None
+    for p in room_info['members'].values():
+        if p['alive'] and (best is None or p['score'] > best['score']):
+            best = p
+    center = body_head(best['body']) if best else cell_index(w // 2, h // 2, w)
+    info = view_frame(room_info, 'key', center, (VIEW_W, VIEW_H), new_view())
+    return ENCODERS[('key', fmt)](room_name, info)
 
-async def broadcast_room_state(room_name):
-    room_info = rooms.get(room_name, {'food': [], 'running': False})
-    players_subset = {pid: p for pid, p in players.items() if p.get('room') == room_name}
+
+def encode_keyframe(room_name, room_info):
     state = {
         'type': 'state',
-        'players': players_subset,
+        'tick': room_info['tick'],
+        'time': room_info['sent_ms'],
+        'players': {pid: player_state(p, room_info['w']) for pid, p in room_info['members'].items()},
         'food': room_info.get('food', []),
-        'w': GRID_W,
-        'h': GRID_H,
+        'w': room_info['w'],
+        'h': room_info['h'],
         'room': room_name,
         'running': room_info.get('running', False),
     }
-    data = json.dumps(state, default=lambda o: list(o) if isinstance(o, set) else o)
-    webs = list(clients.keys())
-    for ws in webs:
+    return json.dumps(state)
+
+
+def prune_delta(delta):
+    # players that joined this frame are sent whole, so drop their own
+    # per-tick changes or the client would apply them twice
+    for pid in delta['join']:
+        delta['upd'].pop(pid, None)
+        delta['heads'].pop(pid, None)
+        delta['tails'].pop(pid, None)
+
+
+def release_slots(room_info):
+    # Slots of departed players stay reserved until the frame announcing the
+    # departure has been encoded, then go back on the free list.
+    slots = room_info['slots']
+    if len(slots) == len(room_info['members']):
+        return
+    for pid in [pid for pid in slots if pid not in room_info['members']]:
+        room_info['free_slots'].append(slots.pop(pid))
+
+
+def encode_delta(room_name, room_info):
+    delta = room_info['delta']
+    frame = {
+        'type': 'delta',
+        'tick': room_info['tick'],
+        'time': room_info['sent_ms'],
+        'room': room_name,
+        'running': room_info.get('running', False),
+    }
+    for key, value in delta.items():
+        if value:
+            frame[key] = value
+    if delta['join']:
+        frame['join'] = {pid: player_state(p, room_info['w']) for pid, p in delta['join'].items()}
+    return json.dumps(frame)
+
+
+# Binary frames, all network byte order. Cells are packed y * w + x indices,
+# two bytes each ('H') or four ('I') once the board has more than 65535
+# cells. Strings are a one-byte length followed by UTF-8.
+#
+#   header   B kind (1 keyframe, 2 delta), I tick, I time, B running,
+#            H w, H h
+#   keyframe header, str room, H n + n cells of food, H n + n players
+#   delta    header, H n + n leaving slots, H n + n joining players,
+#            H n + n updates, H n + n (H slot, cell) heads,
+#            H n + n (H slot, H count) tails, H n + n cells of food removed,
+#            H n + n cells of food added
+#   player   H slot, str id, str name, str color, B alive, I score,
+#            I n + n cells of snake, head first
+#   update   H slot, B mask (1 alive, 2 score, 4 name), then B alive,
+#            I score and str name for each bit set
+FRAME_KEY = 1
+FRAME_DELTA = 2
+UPD_ALIVE = 1
+UPD_SCORE = 2
+UPD_NAME = 4
+
+
+def cell_format(room_info):
+    return 'H' if room_info['w'] * room_info['h'] <= 0xFFFF else 'I'
+
+
+def pack_str(out, value):
+    raw = str(value).encode('utf-8')[:255]
+    out += struct.pack('!B', len(raw))
+    out += raw
+
+
+def pack_cells(out, count_fmt, cells, cf, w):
+    out += struct.pack(f'!{count_fmt}{len(cells)}{cf}', len(cells), *[y * w + x for x, y in cells])
+
+
+def pack_player(out, slot, p, cf):
+    out += struct.pack('!H', slot)
+    pack_str(out, p['id'])
+    pack_str(out, p.get('name', ''))
+    pack_str(out, p.get('color', ''))
+    out += struct.pack('!BI', bool(p.get('alive')), p.get('score', 0))
+    cells = body_cells(p['body'])
+    out += struct.pack(f'!I{len(cells)}{cf}', len(cells), *cells)
+
+
+def pack_header(out, kind, room_info):
+    out += struct.pack('!BIIBHH', kind, room_info['tick'], room_info['sent_ms'], bool(room_info.get('running')),
+                       room_info['w'], room_info['h'])
+
+
+def encode_keyframe_bin(room_name, room_info):
+    cf = cell_format(room_info)
+    slots = room_info['slots']
+    out = bytearray()
+    pack_header(out, FRAME_KEY, room_info)
+    pack_str(out, room_name)
+    pack_cells(out, 'H', room_info['food'], cf, room_info['w'])
+    out += struct.pack('!H', len(room_info['members']))
+    for pid, p in room_info['members'].items():
+        pack_player(out, slots[pid], p, cf)
+    return bytes(out)
+
+
+def encode_delta_bin(room_name, room_info):
+    cf = cell_format(room_info)
+    w = room_info['w']
+    slots = room_info['slots']
+    delta = room_info['delta']
+    out = bytearray()
+    pack_header(out, FRAME_DELTA, room_info)
+    leave = delta['leave']
+    out += struct.pack(f'!H{len(leave)}H', len(leave), *[slots[pid] for pid in leave])
+    out += struct.pack('!H', len(delta['join']))
+    for pid, p in delta['join'].items():
+        pack_player(out, slots[pid], p, cf)
+    out += struct.pack('!H', len(delta['upd']))
+    for pid, fields in delta['upd'].items():
+        mask = ((UPD_ALIVE if 'alive' in fields else 0)
+                | (UPD_SCORE if 'score' in fields else 0)
+                | (UPD_NAME if 'name' in fields else 0))
+        out += struct.pack('!HB', slots[pid], mask)
+        if 'alive' in fields:
+            out += struct.pack('!B', bool(fields['alive']))
+        if 'score' in fields:
+            out += struct.pack('!I', fields['score'])
+        if 'name' in fields:
+            pack_str(out, fields['name'])
+    heads = []
+    for pid, (x, y) in delta['heads'].items():
+        heads += (slots[pid], y * w + x)
+    out += struct.pack('!H' + ('H' + cf) * len(delta['heads']), len(delta['heads']), *heads)
+    tails = []
+    for pid, count in delta['tails'].items():
+        tails += (slots[pid], count)
+    out += struct.pack(f'!H{len(tails)}H', len(delta['tails']), *tails)
+    pack_cells(out, 'H', delta['food_del'], cf, w)
+    pack_cells(out, 'H', delta['food_add'], cf, w)
+    return bytes(out)
+
+
+ENCODERS = {
+    ('key', 'json'): encode_keyframe,
+    ('delta', 'json'): encode_delta,
+    ('key', 'bin'): encode_keyframe_bin,
+    ('delta', 'bin'): encode_delta_bin,
+}
+
+
+# Match log: an append-only bytearray per room with everything needed to
+# re-run the room's simulation (snake_replay.py does that headless). Each
+# start_room() begins a fresh one, so it only ever holds the current match:
+#
+#   header  '!4sBQHH'  LOG_MAGIC, LOG_VERSION, rng seed, board w, board h
+#   record  '!IBH'     tick, op, player number, then per op:
+#     LOG_JOIN   '!bbBI' dir x/y, alive, score, pid str, name str, then
+#                '!H' cell count and '!I' cells, head first
+#     LOG_LEAVE  -
+#     LOG_START  '!HQHH' interval ms, new rng seed, board w, board h
+#     LOG_DIR    '!B'    index into DIRECTION_LIST of the turn step_room took
+#     LOG_CHECK  '!I'    room_digest() after the tick's step
+#     LOG_END    -       only in room_log(): the tick the log was taken at
+#
+# Strings are '!B' length + utf-8. 'tick' is the room's tick counter when
+# the record was written: joins, leaves and starts happen between ticks,
+# turns and checks inside tick_room() before the counter moves on, so on
+# replay every record with tick N is applied and then tick N + 1 is run.
+LOG_MAGIC = b'SNKL'
+LOG_VERSION = 3
+LOG_JOIN, LOG_LEAVE, LOG_START, LOG_DIR, LOG_CHECK, LOG_END = range(1, 7)
+DIRECTION_LIST = list(DIRECTIONS.values())
+# a LOG_CHECK every this many ticks of a running room
+LOG_CHECK_TICKS = KEYFRAME_TICKS
+
+
+def new_match_log(seed, w, h):
+    return bytearray(struct.pack('!4sBQHH', LOG_MAGIC, LOG_VERSION, seed, w, h))
+
+
+def log_record(room_info, op, pid=None, payload=b''):
+    number = 0
+    if pid is not None:
+        ids = room_info['log_ids']
+        number = ids.get(pid)
+        if number is None:
+            number = ids[pid] = len(ids) + 1
+    log = room_info['log']
+    log += struct.pack('!IBH', room_info['tick'], op, number)
+    log += payload
+
+
+def log_join(room_info, pid, p):
+    payload = bytearray(struct.pack('!bbBI', p['dir'][0], p['dir'][1], p['alive'], p['score']))
+    pack_str(payload, pid)
+    pack_str(payload, p['name'])
+    cells = body_cells(p['body'])
+    payload += struct.pack(f'!H{len(cells)}I', len(cells), *cells)
+    log_record(room_info, LOG_JOIN, pid, payload)
+
+
+def room_digest(room_info):
+    # crc32 of everything the simulation decides: bodies, liveness, scores
+    # and food, in member order
+    out = bytearray()
+    for p in room_info['members'].values():
+        cells = body_cells(p['body'])
+        out += struct.pack(f'!BI{len(cells)}I', p['alive'], p['score'], *cells)
+    for x, y in room_info['food']:
+        out += struct.pack('!HH', x, y)
+    return zlib.crc32(out)
+
+
+def room_log(room_info):
+    return bytes(room_info['log']) + struct.pack('!IBH', room_info['tick'], LOG_END, 0)
+
+
+def select_subprotocol(connection, subprotocols):
+    # Browsers fail the handshake if they offered subprotocols and none was
+    # picked, so answer with the JSON one rather than nothing.
+    if BINARY_SUBPROTOCOL in subprotocols:
+        return BINARY_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in subprotocols:
+        return JSON_SUBPROTOCOL
+    return None
+
+
+def wire_format(ws):
+    return 'bin' if getattr(ws, 'subprotocol', None) == BINARY_SUBPROTOCOL else 'json'
+
+
+def open_outbox(ws):
+    # Every connection gets a small queue of outgoing frames drained by its
+    # own writer task, so the tick only ever appends to a deque.
+    box = {
+        'format': wire_format(ws),
+        'queue': deque(),
+        'ready': asyncio.Event(),
+        'dropped': 0,
+        'lagging_since': None,
+    }
+    box['writer'] = asyncio.create_task(outbox_writer(ws, box))
+    outboxes[ws] = box
+    return box
+
+
+def close_outbox(ws):
+    box = outboxes.pop(ws, None)
+    if box is not None:
+        box['writer'].cancel()
+
+
+async def outbox_writer(ws, box):
+    queue = box['queue']
+    while True:
+        if not queue:
+            box['lagging_since'] = None
+            box['ready'].clear()
+            await box['ready'].wait()
+            continue
+        data = queue.popleft()
         try:
-            pid = clients.get(ws)
-            if not pid:
-                continue
-            p = players.get(pid)
-            if not p:
-                continue
-            if p.get('room') != room_name:
-                continue
             await ws.send(data)
         except Exception:
-            pass
+            outbox_counters['send_failures'] += 1
+            return
+        traffic_counters['bytes_out'] += len(data)
+
+
+def queue_frame(ws, data, room_info=None):
+    # Latest state wins: when a client is OUTBOX_SIZE frames behind, its
+    # queued frames are stale, so drop them. A delta cannot be applied
+    # after a gap, so in that case the socket is handed a keyframe on the
+    # next tick instead. Clients that stay behind for SLOW_CLIENT_TIMEOUT
+    # seconds are disconnected.
+    box = outboxes.get(ws)
+    if box is None:
+        return
+    queue = box['queue']
+    if len(queue) >= OUTBOX_SIZE:
+        now = time.monotonic()
+        if box['lagging_since'] is None:
+            box['lagging_since'] = now
+        elif now - box['lagging_since'] > SLOW_CLIENT_TIMEOUT:
+            outbox_counters['slow_disconnects'] += 1
+            close_outbox(ws)
+            asyncio.create_task(ws.close(1008, 'too slow'))
+            return
+        dropped = len(queue)
+        queue.clear()
+        if room_info is not None:
+            dropped += 1
+            room_info['need_key'].add(ws)
+            data = None
+        box['dropped'] += dropped
+        outbox_counters['frames_dropped'] += dropped
+        if data is None:
+            return
+    queue.append(data)
+    box['ready'].set()
+
+
+def snapshot_histogram(hist):
+    return {
+        'bounds': list(hist['bounds']),
+        'counts': list(hist['counts']),
+        'sum': hist['sum'],
+        'count': hist['count'],
+    }
+
+
+def is_echo(message):
+    # the latency pages send bare performance.now() values such as
+    # "1234.5"; those are echoed without touching json or any lock
+    if not isinstance(message, str) or message[:1] == '{':
+        return False
+    try:
+        float(message)
+    except ValueError:
+        return False
+    return True
+
+
+def open_rtt_probe(websocket):
+    rtt_probes[websocket] = {'hist': new_histogram(RTT_BUCKETS_MS), 'last': 0.0}
+    return rtt_probes[websocket]
+
+
+def close_rtt_probe(websocket):
+    probe = rtt_probes.pop(websocket, None)
+    if probe is not None:
+        merge_histogram(rtt_closed, probe['hist'])
+
+
+def merge_histogram(into, hist):
+    into['counts'] = [a + b for a, b in zip(into['counts'], hist['counts'])]
+    into['sum'] += hist['sum']
+    into['count'] += hist['count']
+
+
+async def probe_rtt(websocket, probe):
+    # a protocol ping at most every RTT_PROBE_EVERY; the pong is recorded by
+    # a callback so the echo loop never waits for it
+    now = time.monotonic()
+    if now - probe['last'] < RTT_PROBE_EVERY:
+        return
+    probe['last'] = now
+    try:
+        pong = await websocket.ping()
+    except Exception:
+        return
 
+    def record(future):
+        if not future.cancelled() and future.exception() is None:
+            observe(probe['hist'], future.result() * 1000)
+    pong.add_done_callback(record)
 
-async def game_loop():
+
+async def echo_handler(websocket):
+    probe = open_rtt_probe(websocket)
+    try:
+        async for message in websocket:
+            await websocket.send(message)
+            await probe_rtt(websocket, probe)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        close_rtt_probe(websocket)
+
+
+# Leaderboard: the best score of every (human) player, per room and across
+# rooms, kept as the top LEADERBOARD_SIZE of each. leaderboard_score()
+# updates them as scores go up; stats_loop() re-serializes the boards that
+# changed into leaderboard_cache, which /api/leaderboard serves as is, and
+# writes it to leaderboard_path at most every LEADERBOARD_SAVE_EVERY
+# seconds. Only the LEADERBOARD_ROOMS most recently updated room boards are
+# kept. In sharded mode every worker ranks the rooms it owns and the router
+# merges their boards every LEADERBOARD_PULL_EVERY seconds, see
+# pull_leaderboards().
+LEADERBOARD_SIZE = 20
+LEADERBOARD_ROOMS = 500
+LEADERBOARD_SAVE_EVERY = 5.0
+LEADERBOARD_PULL_EVERY = 1.0
+LEADERBOARD_PATH = '/api/leaderboard'
+# where the boards are loaded from and saved to, None to keep them in memory
+leaderboard_path = None
+
+
+def new_board():
+    # 'entries' is the top-K, best first, as (-score, seq, pid, name, room)
+    # tuples so bisect keeps them sorted; seq puts whoever got to a score
+    # first ahead. 'by_pid' maps the pids on the board to their entry.
+    return {'entries': [], 'by_pid': {}}
+
+
+def board_update(board, entry):
+    # O(1) for a score that doesn't make the board, O(K) otherwise
+    entries, by_pid = board['entries'], board['by_pid']
+    pid = entry[2]
+    old = by_pid.get(pid)
+    if old is not None:
+        if entry[0] >= old[0]:
+            return False
+        del entries[bisect.bisect_left(entries, old)]
+    elif len(entries) >= LEADERBOARD_SIZE and entry > entries[-1]:
+        return False
+    bisect.insort(entries, entry)
+    by_pid[pid] = entry
+    if len(entries) > LEADERBOARD_SIZE:
+        del by_pid[entries.pop()[2]]
+    return True
+
+
+def board_entries(board):
+    return [{'id': pid, 'name': name, 'score': -score, 'room': room}
+            for score, _, pid, name, room in board['entries']]
+
+
+def reset_leaderboards():
+    global leaderboards
+    # 'rooms' is ordered least recently updated first, 'dirty' holds the
+    # rooms whose board changed since the last publish and 'json' the
+    # serialized entries of every room board
+    leaderboards = {'global': new_board(), 'rooms': OrderedDict(), 'seq': 0, 'dirty': set(), 'json': {},
+                    'saved': None}
+
+
+def leaderboard_score(room_name, pid, name, score):
+    leaderboards['seq'] += 1
+    entry = (-score, leaderboards['seq'], pid, name, room_name)
+    boards = leaderboards['rooms']
+    board = boards.get(room_name)
+    if board is None:
+        if len(boards) >= LEADERBOARD_ROOMS:
+            oldest, _ = boards.popitem(last=False)
+            leaderboards['dirty'].add(oldest)
+        board = boards[room_name] = new_board()
+    else:
+        boards.move_to_end(room_name)
+    # | rather than or: the global board needs the update either way
+    if board_update(board, entry) | board_update(leaderboards['global'], entry):
+        leaderboards['dirty'].add(room_name)
+
+
+def leaderboard_snapshot():
+    # the /api/leaderboard response, with the ETag and gzipped copy
+    # cached_page() keeps for pages; gzip's fastest level, since this can
+    # be rebuilt every tick
+    body = ('{"global": %s, "rooms": {%s}}' % (
+        json.dumps(board_entries(leaderboards['global'])),
+        ', '.join(f'{json.dumps(name)}: {leaderboards["json"][name]}' for name in leaderboards['rooms']),
+    )).encode('utf-8')
+    return {'etag': '"%s"' % hashlib.sha1(body).hexdigest()[:20], 'body': body, 'gzip': gzip.compress(body, 1)}
+
+
+def publish_leaderboard(force=False):
+    global leaderboard_cache
+    dirty = leaderboards['dirty']
+    if not dirty and not force:
+        return
+    fragments = leaderboards['json']
+    for name in dirty:
+        board = leaderboards['rooms'].get(name)
+        if board is None:
+            fragments.pop(name, None)
+        else:
+            fragments[name] = json.dumps(board_entries(board))
+    dirty.clear()
+    leaderboard_cache = leaderboard_snapshot()
+
+
+def absorb_leaderboard(saved):
+    # Feeds an /api/leaderboard body into the boards: the global board
+    # first, which can hold entries from rooms that have been dropped since,
+    # then the rooms in order, least recently updated first. Entries come
+    # best first, so equal scores keep their order.
+    for e in saved.get('global', []):
+        leaderboards['seq'] += 1
+        board_update(leaderboards['global'], (-e['score'], leaderboards['seq'], e['id'], e['name'], e['room']))
+    for name, entries in saved.get('rooms', {}).items():
+        for e in entries:
+            leaderboard_score(name, e['id'], e['name'], e['score'])
+
+
+def load_leaderboard(path):
+    # starts over from the boards saved at `path`, if there are any
+    global leaderboard_path
+    leaderboard_path = path
+    reset_leaderboards()
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                absorb_leaderboard(json.loads(f.read()))
+        except (OSError, ValueError) as e:
+            log_event('GAME', 'LEADERBOARD_ERROR', path=path, error=e)
+    publish_leaderboard(force=True)
+    leaderboards['saved'] = leaderboard_cache['body']
+
+
+def worker_http(connection, ws_request):
+    # A worker's only plain HTTP answers: its boards and its stats, for the
+    # router's pull_leaderboards() and pull_worker_stats(). Everything else
+    # goes on to the handshake.
+    if ws_request.headers.get('Upgrade', '').lower() == 'websocket':
+        return None
+    path = urlsplit(ws_request.path).path
+    if path == LEADERBOARD_PATH:
+        return http_response(200, Headers({'Content-Type': 'application/json'}), leaderboard_cache['body'])
+    if path == WS_STATS_PATH:
+        return http_response(200, Headers({'Content-Type': 'application/json'}), json.dumps(ws_stats).encode())
+    return None
+
+
+def fetch_worker(port, path):
+    with urlopen(f'http://127.0.0.1:{port}{path}', timeout=2.0) as response:
+        return response.read()
+
+
+async def pull_leaderboards():
+    # Sharded mode: each worker only ranks the rooms it owns, so the
+    # router's boards are rebuilt from all of theirs whenever one changed.
+    # Each room lives on one worker; the global board is the best of the
+    # workers' global boards.
+    bodies = {}
+    while True:
+        await asyncio.sleep(LEADERBOARD_PULL_EVERY)
+        fetched = {}
+        for port in worker_ports:
+            try:
+                fetched[port] = await asyncio.to_thread(fetch_worker, port, LEADERBOARD_PATH)
+            except (OSError, ValueError) as e:
+                # keep what we had from a worker that didn't answer
+                fetched[port] = bodies.get(port)
+                log_event('GAME', 'LEADERBOARD_ERROR', port=port, error=e)
+        if fetched == bodies:
+            continue
+        bodies = fetched
+        reset_leaderboards()
+        for body in bodies.values():
+            if body:
+                absorb_leaderboard(json.loads(body))
+        publish_leaderboard(force=True)
+
+
+def write_file(path, data):
+    # whole or not at all: a crash mid-write leaves the last good copy
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+async def save_leaderboard():
+    # batched: whatever changed since the last save goes out in one write
+    body = leaderboard_cache['body']
+    if leaderboard_path is None or body is leaderboards['saved']:
+        return
+    leaderboards['saved'] = body
+    try:
+        await asyncio.to_thread(write_file, leaderboard_path, body)
+    except OSError as e:
+        log_event('GAME', 'LEADERBOARD_ERROR', path=leaderboard_path, error=e)
+
+
+reset_leaderboards()
+leaderboard_cache = leaderboard_snapshot()
+
+
+# sharded mode, in the router: worker port -> the ws_stats that worker last
+# reported, folded into the router's own by publish_stats()
+worker_stats = {}
+# snapshot values that don't add up across processes
+STATS_MAX = ('max_queue_depth', 'last_loop_lag_ms')
+
+
+def merge_stats(total, stats):
+    # Rooms live on one worker each, so their entries never collide;
+    # histograms, counters and per-event counts add up.
+    for key, value in stats.items():
+        mine = total.get(key)
+        if key == 'rooms':
+            total[key] = {**(mine or {}), **value}
+        elif key in STATS_MAX:
+            total[key] = max(mine or 0, value)
+        elif isinstance(value, dict) and 'counts' in value:
+            if mine is None:
+                # a copy, since the merges below would change the worker's
+                total[key] = dict(value)
+            else:
+                merge_histogram(mine, value)
+        elif isinstance(value, dict):
+            merged = dict(mine or {})
+            for name, count in value.items():
+                merged[name] = merged.get(name, 0) + count
+            total[key] = merged
+        elif isinstance(value, (int, float)):
+            total[key] = (mine or 0) + value
+
+
+async def pull_worker_stats():
+    # Sharded mode: /metrics and /api/ws-stats are served by the router, so
+    # it keeps the workers' latest snapshots to add to its own.
+    while True:
+        await asyncio.sleep(LEADERBOARD_PULL_EVERY)
+        for port in worker_ports:
+            try:
+                worker_stats[port] = json.loads(await asyncio.to_thread(fetch_worker, port, WS_STATS_PATH))
+            except (OSError, ValueError) as e:
+                log_event('GAME', 'STATS_ERROR', port=port, error=e)
+
+
+def publish_stats():
+    depths = [len(box['queue']) for box in outboxes.values()]
+    stats = dict(outbox_counters)
+    stats['clients'] = len(outboxes)
+    stats['queued_frames'] = sum(depths)
+    stats['max_queue_depth'] = max(depths, default=0)
+    stats['lagging_clients'] = sum(1 for box in outboxes.values() if box['lagging_since'] is not None)
+    for key in ('duration_ms', 'lateness_ms'):
+        stats['tick_' + key] = snapshot_histogram(tick_stats[key])
+    # every sample since startup: the open connections plus the closed ones
+    rtt = new_histogram(RTT_BUCKETS_MS)
+    merge_histogram(rtt, rtt_closed)
+    for probe in rtt_probes.values():
+        merge_histogram(rtt, probe['hist'])
+    stats['rtt_connections'] = len(rtt_probes)
+    stats['rtt_ms'] = snapshot_histogram(rtt)
+    stats['loop_lag_ms'] = snapshot_histogram(loop_stats['lag_ms'])
+    stats['last_loop_lag_ms'] = loop_stats['last_lag_ms']
+    now = time.monotonic()
+    for key in ('messages_in', 'bytes_out'):
+        stats[key] = traffic_counters[key]
+        elapsed = now - traffic_last['at'] if traffic_last['at'] is not None else 0.0
+        stats[key + '_per_s'] = (traffic_counters[key] - traffic_last[key]) / elapsed if elapsed > 0 else 0.0
+        traffic_last[key] = traffic_counters[key]
+    traffic_last['at'] = now
+    stats['tick_overruns'] = tick_stats['overruns']
+    stats['ticks_skipped'] = tick_stats['skipped']
+    stats['events'] = dict(event_counts)
+    stats['log_dropped'] = log_counters['dropped']
+    hibernated = sum(1 for room_info in rooms.values() if room_info['idle_since'] is not None)
+    stats['rooms_active'] = len(rooms) - hibernated
+    stats['rooms_hibernated'] = hibernated
+    stats['rooms_evicted'] = room_counters['evicted']
+    stats['sessions_detached'] = sum(1 for p in players.values() if p.get('detached_at') is not None)
+    stats['sessions_resumed'] = session_counters['resumed']
+    stats['sessions_expired'] = session_counters['expired']
+    stats['rooms'] = {
+        name: {
+            'hibernated': room_info['idle_since'] is not None,
+            'w': room_info['w'],
+            'h': room_info['h'],
+            'players': len(room_info['members']),
+            'bots': len(room_info['bots']),
+            'bot_ms': room_info['bot_ms'],
+            'spectators': sum(len(watchers) for formats in room_info['audience'].values()
+                              for watchers in formats.values()),
+            'last_tick_ms': room_info['last_tick_ms'],
+            'overruns': room_info['overruns'],
+        }
+        for name, room_info in rooms.items()
+    }
+    for snapshot in worker_stats.values():
+        merge_stats(stats, snapshot)
+    global ws_stats
+    ws_stats = stats
+
+
+def broadcast_room_state(room_name):
+    room_info = rooms.get(room_name)
+    if room_info is None:
+        return
+    room_info['tick'] += 1
+    room_info['sent_ms'] = server_ms()
+    if not room_info['sockets']:
+        room_info['delta'] = new_delta()
+        release_slots(room_info)
+        return
+    keyframe = room_info['force_key'] or room_info['tick'] % KEYFRAME_TICKS == 0
+    need_key = room_info['need_key']
+    room_info['need_key'] = set()
+    prune_delta(room_info['delta'])
+    # each (frame kind, wire format) pair is encoded at most once per tick
+    # and the same bytes are shared by every socket that needs it
+    frames = {}
+    sockets = room_info['sockets']
+    bucketed = room_info['snake_buckets'] is not None
+    for ws in list(sockets):
+        box = outboxes.get(ws)
+        if box is None:
+            continue
+        kind = 'key' if keyframe or ws in need_key else 'delta'
+        key = (kind, box['format'])
+        if bucketed:
+            # a board too big to share: everyone gets their own view
+            p = room_info['members'][sockets[ws]]
+            info = view_frame(room_info, kind, body_head(p['body']), p.get('view', (VIEW_W, VIEW_H)),
+                              room_info['views'][ws], p['id'])
+            queue_frame(ws, ENCODERS[key](room_name, info), room_info if kind == 'delta' else None)
+            continue
+        data = frames.get(key)
+        if data is None:
+            data = frames[key] = ENCODERS[key](room_name, room_info)
+        queue_frame(ws, data, room_info if kind == 'delta' else None)
+    room_info['delta'] = new_delta()
+    room_info['force_key'] = False
+    release_slots(room_info)
+
+
+def step_room(room_name, room_info):
+    cells = room_info['cells']
+    food_cells = room_info['food_cells']
+    free = room_info['free']
+    delta = room_info['delta']
+    buckets = room_info['snake_buckets']
+    w, h = room_info['w'], room_info['h']
+    for pid, p in list(room_info['members'].items()):
+        if not p.get('alive'):
+            continue
+        if p['inputs']:
+            p['dir'] = p['inputs'].popleft()
+            log_record(room_info, LOG_DIR, pid, struct.pack('!B', DIRECTION_LIST.index(p['dir'])))
+        body = p['body']
+        head = body_head(body)
+        hx, hy = head % w, head // w
+        dx, dy = p.get('dir', [1, 0])
+        nx, ny = hx + dx, hy + dy
+        if nx < 0 or nx >= w or ny < 0 or ny >= h:
+            p['alive'] = False
+            mark_update(room_info, pid, alive=False)
+            continue
+        idx = ny * w + nx
+        # covers both running into yourself and into another snake
+        if idx in cells:
+            p['alive'] = False
+            mark_update(room_info, pid, alive=False)
+            continue
+
+        body_push(body, idx)
+        cells[idx] = pid
+        free_take(free, idx)
+        if buckets is not None:
+            bucket_add(buckets, bucket_of(room_info, idx), pid)
+        delta['heads'][pid] = [nx, ny]
+        if idx in food_cells:
+            remove_food(room_info, nx, ny)
+            p['score'] = p.get('score', 0) + 1
+            mark_update(room_info, pid, score=p['score'])
+            if not p.get('bot'):
+                leaderboard_score(room_name, pid, p['name'], p['score'])
+        elif body['len'] > 1:
+            tidx = body_pop(body)
+            if cells.get(tidx) == pid:
+                del cells[tidx]
+                free_put(free, tidx)
+            if buckets is not None:
+                bucket_drop(buckets, bucket_of(room_info, tidx), pid)
+            delta['tails'][pid] = 1
+
+
+def start_room(room_info, seed=None, size=None):
+    # (re)starts the match, on a board of `size` (w, h) if given: every
+    # member respawns and the room's rng is reseeded, so a match can be
+    # replayed from its LOG_START record
+    if seed is None:
+        seed = random.getrandbits(63)
+    seed &= (1 << 64) - 1
+    w, h = size or (room_info['w'], room_info['h'])
+    # the members are re-joined as they are into a new log, which the
+    # previous match's records would only bloat
+    room_info['log'] = new_match_log(seed, room_info['w'], room_info['h'])
+    room_info['log_ids'] = {}
+    for pid, p in room_info['members'].items():
+        log_join(room_info, pid, p)
+    log_record(room_info, LOG_START, payload=struct.pack('!HQHH', int(room_info['interval'] * 1000), seed, w, h))
+    room_info['rng'].seed(seed)
+    room_info['running'] = True
+    set_grid(room_info, w, h)
+    for pid, p in room_info['members'].items():
+        p['body'] = spawn_body(room_info)
+        p['dir'] = [1, 0]
+        p['inputs'].clear()
+        p['alive'] = True
+        p['score'] = 0
+        occupy_snake(room_info, pid, p['body'])
+    room_info['force_key'] = True
+
+
+def bot_body(room_info):
+    # a random free cell, so bots don't all pile up in the spawn corner
+    free = room_info['free']
+    if not free['size']:
+        return spawn_body(room_info, random)
+    return new_body([free['cells'][random.randrange(free['size'])]])
+
+
+def new_bot(room_name, room_info):
+    pid = 'bot-' + uuid.uuid4().hex[:8]
+    return {
+        'id': pid,
+        'name': f'Bot-{pid[4:8]}',
+        'body': bot_body(room_info),
+        'dir': [1, 0],
+        'inputs': deque(maxlen=INPUT_QUEUE),
+        'alive': True,
+        'score': 0,
+        'color': '#{:06x}'.format(random.randint(0x444444, 0xffffff)),
+        'room': room_name,
+        'view': (VIEW_W, VIEW_H),
+        'bot': True,
+    }
+
+
+def set_bots(room_name, count):
+    # Adds or removes bots until the room has `count`. They join and leave
+    # like players, so they are in the match log and in every frame.
+    room_info = get_room(room_name)
+    bots = room_info['bots']
+    count = min(MAX_BOTS if np is not None else MAX_BOTS_PYTHON, max(0, count))
+    while len(bots) > count:
+        pid = next(iter(bots))
+        leave_room(pid)
+        del bots[pid]
+        players.pop(pid, None)
+    while len(bots) < count:
+        p = new_bot(room_name, room_info)
+        players[p['id']] = bots[p['id']] = p
+        enter_room(p['id'], room_name)
+
+
+def respawn_bots(room_name, room_info):
+    # a respawn is a leave and a join, so replays need no bot logic
+    tick = room_info['tick']
+    for pid, p in room_info['bots'].items():
+        if p['alive']:
+            p.pop('dead_since', None)
+            continue
+        if tick - p.setdefault('dead_since', tick) < BOT_RESPAWN_TICKS:
+            continue
+        leave_room(pid)
+        del p['dead_since']
+        p['inputs'].clear()
+        p.update(body=bot_body(room_info), dir=[1, 0], alive=True, score=0)
+        enter_room(pid, room_name)
+
+
+def bot_search(room_info, head, x, y, need):
+    # Breadth-first search over the free cells within BOT_SIGHT of `head`,
+    # starting at (x, y), one step at a time like bot_options_numpy().
+    # Returns (steps to the nearest food or BOT_BLIND, cells reached,
+    # whether it got to the edge of the window), or None if (x, y) is a
+    # crash. Stops as soon as the food is found and the move is known to
+    # be safe; the cell count only matters for moves that aren't.
+    w, h = room_info['w'], room_info['h']
+    cells, food_cells = room_info['cells'], room_info['food_cells']
+    hx, hy = head % w, head // w
+    x0, x1 = max(0, hx - BOT_SIGHT), min(w - 1, hx + BOT_SIGHT)
+    y0, y1 = max(0, hy - BOT_SIGHT), min(h - 1, hy + BOT_SIGHT)
+    start = y * w + x
+    if x < 0 or x >= w or y < 0 or y >= h or start in cells:
+        return None
+    seen = {start}
+    frontier = [(x, y)]
+    dist = 0 if start in food_cells else BOT_BLIND
+    edge = x in (hx - BOT_SIGHT, hx + BOT_SIGHT) or y in (hy - BOT_SIGHT, hy + BOT_SIGHT)
+    step = 0
+    while frontier and step < BOT_STEPS:
+        if dist < BOT_BLIND and (edge or len(seen) >= need):
+            break
+        step += 1
+        grown = []
+        for x, y in frontier:
+            for nx, ny in ((x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)):
+                if nx < x0 or nx > x1 or ny < y0 or ny > y1:
+                    continue
+                idx = ny * w + nx
+                if idx in seen or idx in cells:
+                    continue
+                seen.add(idx)
+                grown.append((nx, ny))
+                if dist == BOT_BLIND and idx in food_cells:
+                    dist = step
+                if nx in (hx - BOT_SIGHT, hx + BOT_SIGHT) or ny in (hy - BOT_SIGHT, hy + BOT_SIGHT):
+                    edge = True
+        frontier = grown
+    return dist, len(seen), edge
+
+
+def bot_options(room_info, p):
+    # (direction, food distance, cells reached, reached the edge) for each
+    # move of one bot that doesn't crash right away
+    w = room_info['w']
+    head = body_head(p['body'])
+    hx, hy = head % w, head // w
+    options = []
+    for name, (dx, dy) in DIRECTIONS.items():
+        found = bot_search(room_info, head, hx + dx, hy + dy, p['body']['len'])
+        if found is not None:
+            options.append((name,) + found)
+    return options
+
+
+def bot_options_numpy(room_info, bots):
+    # bot_options() for every bot at once. Each bot's window is cut from a
+    # copy of the board padded with BOT_SIGHT blocked cells a side, and
+    # every row of it packed into the bits of one uint64 (so BOT_SIGHT is
+    # at most 31). The four moves of all the bots then grow together one
+    # step per loop as a (bots, 4, rows) array of bit masks.
+    w, h = room_info['w'], room_info['h']
+    r = BOT_SIGHT
+    size = 2 * r + 1
+    free = np.zeros((h + 2 * r, w + 2 * r), dtype=bool)
+    free[r:r + h, r:r + w] = True
+    taken = np.fromiter(room_info['cells'], dtype=np.int64, count=len(room_info['cells']))
+    free[taken // w + r, taken % w + r] = False
+    food = np.zeros_like(free)
+    eaten = np.fromiter(room_info['food_cells'], dtype=np.int64, count=len(room_info['food_cells']))
+    food[eaten // w + r, eaten % w + r] = True
+    heads = np.array([body_head(p['body']) for p in bots], dtype=np.int64)
+    hy, hx = heads // w, heads % w
+
+    def rows(grid):
+        # padded (y, x) is board (y - r, x - r), so the window at the
+        # head's own coordinates is the one centred on it
+        window = sliding_window_view(grid, (size, size))[hy, hx]
+        packed = np.zeros((len(bots), size, 8), dtype=np.uint8)
+        packed[..., :(size + 7) // 8] = np.packbits(window, axis=-1, bitorder='little')
+        return packed.view('<u8')[:, None, :, 0]
+
+    free = rows(free)
+    food = rows(food)
+    seen = np.zeros((len(bots), 4, size), dtype=np.uint64)
+    for k, (dx, dy) in enumerate(DIRECTION_LIST):
+        seen[:, k, r + dy] = free[:, 0, r + dy] & np.uint64(1 << (r + dx))
+    valid = (seen != 0).any(-1)
+    dist = np.where(((seen & food) != 0).any(-1), 0, BOT_BLIND)
+    frontier = seen.copy()
+    one = np.uint64(1)
+    for step in range(1, BOT_STEPS + 1):
+        grown = (frontier << one) | (frontier >> one)
+        grown[..., 1:] |= frontier[..., :-1]
+        grown[..., :-1] |= frontier[..., 1:]
+        grown &= free
+        grown &= ~seen
+        if not grown.any():
+            break
+        seen |= grown
+        dist[((grown & food) != 0).any(-1) & (dist == BOT_BLIND)] = step
+        frontier = grown
+    area = np.unpackbits(seen.view(np.uint8), axis=-1).sum(-1)
+    sides = np.uint64(1 | 1 << (size - 1))
+    edge = (seen[..., 0] != 0) | (seen[..., -1] != 0) | ((seen & sides) != 0).any(-1)
+    return [
+        [(name, d, a, e) for name, d, a, e, v in zip(DIRECTIONS, *moves) if v]
+        for moves in zip(dist.tolist(), area.tolist(), edge.tolist(), valid.tolist())
+    ]
+
+
+def choose_turn(p, options):
+    # safe moves by food distance, then the roomiest unsafe one; going
+    # straight on wins ties
+    need = p['body']['len']
+    best = None
+    for name, dist, area, edge in options:
+        turn = DIRECTIONS[name] != p['dir']
+        key = (0, dist, turn) if edge or area >= need else (1, -area, turn)
+        if best is None or key < best[0]:
+            best = (key, name)
+    return best[1] if best else None
+
+
+def plan_bots(room_info):
+    # Picks every live bot's turn for the coming tick in one pass. The turn
+    # is queued like a key press, so it is logged as LOG_DIR and a replay
+    # doesn't need to plan again. Draws nothing from the room's rng.
+    bots = [p for p in room_info['bots'].values() if p['alive']]
+    if not bots:
+        return
+    if np is not None:
+        options = bot_options_numpy(room_info, bots)
+    else:
+        options = [bot_options(room_info, p) for p in bots]
+    for p, moves in zip(bots, options):
+        p['inputs'].clear()
+        name = choose_turn(p, moves)
+        if name is not None:
+            queue_input(p, name)
+
+
+def tick_room(room_name, room_info):
+    if room_info.get('running', False):
+        # before the food, which is where a replay puts the logged joins
+        respawn_bots(room_name, room_info)
+        # food only exists in a running match; start_room() clears it
+        target = max(3, room_info['w'] * room_info['h'] // FOOD_AREA)
+        while len(room_info['food']) < target:
+            cell = random_empty_cell(room=room_name)
+            if cell is None:
+                break
+            add_food(room_info, cell)
+        if room_info['bots']:
+            started = time.perf_counter()
+            plan_bots(room_info)
+            room_info['bot_ms'] = (time.perf_counter() - started) * 1000
+        step_room(room_name, room_info)
+        if room_info['tick'] % LOG_CHECK_TICKS == 0:
+            log_record(room_info, LOG_CHECK, payload=struct.pack('!I', room_digest(room_info)))
+    broadcast_room_state(room_name)
+
+
+def room_is_idle(room_info):
+    return not (room_info.get('running') and room_info['members'])
+
+
+def room_is_empty(room_info):
+    return not room_info['members'] and not room_info['audience']
+
+
+async def room_loop(room_name, room_info):
+    # One task per room, ticking at the room's own interval under the room's
+    # own lock. A room that hasn't been started has nothing to simulate, so
+    # it sleeps until wake_room() is called and then ticks once to send out
+    # whatever changed. Once nobody is left the task ends and the room
+    # hibernates until the next wake_room(), or evict_rooms() drops it.
+    #
+    # Ticks are scheduled against absolute monotonic deadlines, so the
+    # period stays `interval` no matter how long a tick takes. A room that
+    # falls behind runs up to MAX_CATCHUP_TICKS ticks back to back, and if
+    # it is further behind than that the missed ticks are skipped.
+    wake = room_info['wake']
+    deadline = time.monotonic()
     while True:
+        if room_is_idle(room_info):
+            await wake.wait()
+            deadline = time.monotonic()
+        wake.clear()
+        started = time.monotonic()
         try:
-            async with state_lock:
-                for room_name, room_info in rooms.items():
-                    if 'food' not in room_info:
-                        room_info['food'] = []
-                    while len(room_info['food']) < 3:
-                        room_info['food'].append(random_empty_cell(room=room_name))
-
-                for room_name, room_info in list(rooms.items()):
-                    running = room_info.get('running', False)
-                    if not running:
-                        continue
-                    for pid, p in list(players.items()):
-                        if p.get('room') != room_name:
-                            continue
-                        if not p.get('alive'):
-                            continue
-                        hx, hy = p['snake'][0]
-                        dx, dy = p.get('dir', [1, 0])
-                        nx, ny = hx + dx, hy + dy
-                        if nx < 0 or nx >= GRID_W or ny < 0 or ny >= GRID_H:
-                            p['alive'] = False
-                            continue
-                        if [nx, ny] in p['snake']:
-                            p['alive'] = False
-                            continue
-                        collided = False
-                        for oid, op in players.items():
-                            if op.get('room') != room_name:
-                                continue
-                            if oid == pid:
-                                continue
-                            if [nx, ny] in op.get('snake', []):
-                                collided = True
-                                break
-                        if collided:
-                            p['alive'] = False
-                            continue
-
-                        p['snake'].insert(0, [nx, ny])
-                        ate = False
-                        for f in list(room_info.get('food', [])):
-                            if f[0] == nx and f[1] == ny:
-                                try:
-                                    room_info['food'].remove(f)
-                                except ValueError:
-                                    pass
-                                p['score'] = p.get('score', 0) + 1
-                                ate = True
-                                break
-                        if not ate:
-                            if len(p['snake']) > 1:
-                                p['snake'].pop()
-
-                for room_name in list(rooms.keys()):
-                    await broadcast_room_state(room_name)
+            async with room_info['lock']:
+                tick_room(room_name, room_info)
+                if (room_info['bots'] and len(room_info['members']) == len(room_info['bots'])
+                        and not room_info['audience']):
+                    # bots only play while a player (even one inside the
+                    # resume grace) or a spectator is there
+                    set_bots(room_name, 0)
         except Exception as e:
-            print(f"[GAME] loop exception: {e}")
+            log_event('GAME', 'LOOP_ERROR', room=room_name, error=e)
+        finished = time.monotonic()
+        interval = room_info['interval']
+        duration_ms = (finished - started) * 1000
+        room_info['last_tick_ms'] = duration_ms
+        observe(tick_stats['duration_ms'], duration_ms)
+        observe(tick_stats['lateness_ms'], max(0.0, started - deadline) * 1000)
+        if finished - started > interval:
+            room_info['overruns'] += 1
+            tick_stats['overruns'] += 1
+        if room_is_empty(room_info):
+            room_info['idle_since'] = finished
+            return
+        if room_is_idle(room_info):
+            continue
+        deadline += interval
+        behind = finished - deadline
+        if behind > interval * MAX_CATCHUP_TICKS:
+            missed = int(behind // interval)
+            tick_stats['skipped'] += missed
+            deadline += missed * interval
+            behind = finished - deadline
+        if behind < 0:
+            await asyncio.sleep(-behind)
+        else:
+            # catching up: tick again right away, but let other rooms and
+            # the socket handlers run first
+            await asyncio.sleep(0)
+
+
+def wake_room(room_name):
+    room_info = rooms.get(room_name)
+    if room_info is None:
+        return
+    if room_info['task'] is None or room_info['task'].done():
+        room_info['task'] = asyncio.create_task(room_loop(room_name, room_info))
+    room_info['idle_since'] = None
+    room_info['wake'].set()
+
+
+def evict_rooms(now=None):
+    # Drops rooms that have been hibernated for ROOM_TTL with nobody in
+    # them. A room whose lock is held is about to be used, so it stays.
+    if now is None:
+        now = time.monotonic()
+    for name, room_info in list(rooms.items()):
+        since = room_info['idle_since']
+        if since is None or now - since < ROOM_TTL:
+            continue
+        if not room_is_empty(room_info) or room_info['lock'].locked():
+            continue
+        del rooms[name]
+        room_counters['evicted'] += 1
+
+
+async def resume_session(websocket, token):
+    # Hands the player behind a resume token to a new socket, taking over
+    # from the old one if the server hasn't noticed it drop yet. Returns the
+    # pid, or None if the token is unknown or its grace period ran out.
+    pid = sessions.get(token)
+    if pid is None or pid not in players:
+        return None
+    room = players[pid]['room']
+    async with state_lock, room_locks(room):
+        p = players.get(pid)
+        if p is None or p['room'] != room:
+            return None
+        room_info = rooms[room]
+        old = p['socket']
+        if old is not None:
+            detach_socket(room_info, old)
+            clients.pop(old, None)
+            asyncio.create_task(old.close())
+        p['socket'] = websocket
+        p['detached_at'] = None
+        clients[websocket] = pid
+        attach_socket(room_info, pid, websocket)
+        session_counters['resumed'] += 1
+    wake_room(room)
+    return pid
+
+
+async def expire_sessions(now=None):
+    # players whose socket dropped over RESUME_GRACE ago leave for good
+    if now is None:
+        now = time.monotonic()
+    for token, pid in list(sessions.items()):
+        p = players.get(pid)
+        if p is None:
+            del sessions[token]
+            continue
+        if p['detached_at'] is None or now - p['detached_at'] < RESUME_GRACE:
+            continue
+        room = p['room']
+        async with state_lock, room_locks(room):
+            # resumed while we waited for the locks
+            if p['detached_at'] is None or sessions.get(token) != pid:
+                continue
+            leave_room(pid)
+            del players[pid]
+            del sessions[token]
+            session_counters['expired'] += 1
+        wake_room(room)
+
+
+@asynccontextmanager
+async def room_locks(*room_names):
+    # always taken in sorted order so two handlers moving players in
+    # opposite directions can't deadlock
+    async with AsyncExitStack() as stack:
+        for room_name in sorted(set(room_names)):
+            room_info = get_room(room_name)
+            await stack.enter_async_context(room_info['lock'])
+        yield
+
+
+async def stats_loop():
+    last_save = time.monotonic()
+    while True:
+        await expire_sessions()
+        evict_rooms()
+        publish_stats()
+        publish_leaderboard()
+        if time.monotonic() - last_save >= LEADERBOARD_SAVE_EVERY:
+            last_save = time.monotonic()
+            await save_leaderboard()
+        asked = time.monotonic()
         await asyncio.sleep(TICK)
+        lag_ms = max(0.0, time.monotonic() - asked - TICK) * 1000
+        loop_stats['last_lag_ms'] = lag_ms
+        observe(loop_stats['lag_ms'], lag_ms)
+
+
+# /metrics: (metric, type, help, ws_stats key) for the plain numbers in the
+# snapshot; histograms, per-room and per-event series are added below
+METRICS = (
+    ('snake_ws_clients', 'gauge', 'Connected game WebSocket clients.', 'clients'),
+    ('snake_ws_messages_received_total', 'counter', 'Messages received from game clients.', 'messages_in'),
+    ('snake_ws_messages_received_per_second', 'gauge', 'Messages received per second over the last publish interval.', 'messages_in_per_s'),
+    ('snake_ws_bytes_sent_total', 'counter', 'Frame bytes written to game clients.', 'bytes_out'),
+    ('snake_ws_bytes_sent_per_second', 'gauge', 'Frame bytes written per second over the last publish interval.', 'bytes_out_per_s'),
+    ('snake_ws_send_failures_total', 'counter', 'Broadcast frames whose send failed.', 'send_failures'),
+    ('snake_ws_frames_dropped_total', 'counter', 'Frames dropped from full outboxes.', 'frames_dropped'),
+    ('snake_ws_slow_disconnects_total', 'counter', 'Clients disconnected for lagging too long.', 'slow_disconnects'),
+    ('snake_ws_queued_frames', 'gauge', 'Frames waiting in all outboxes.', 'queued_frames'),
+    ('snake_tick_overruns_total', 'counter', 'Room ticks that took longer than their interval.', 'tick_overruns'),
+    ('snake_ticks_skipped_total', 'counter', 'Room ticks skipped to catch up.', 'ticks_skipped'),
+    ('snake_event_loop_lag_last_milliseconds', 'gauge', 'Event loop lag at the last stats tick.', 'last_loop_lag_ms'),
+    ('snake_rooms_active', 'gauge', 'Rooms with a running room task.', 'rooms_active'),
+    ('snake_rooms_hibernated', 'gauge', 'Empty rooms kept without a task until ROOM_TTL runs out.', 'rooms_hibernated'),
+    ('snake_rooms_evicted_total', 'counter', 'Hibernated rooms dropped after ROOM_TTL.', 'rooms_evicted'),
+    ('snake_sessions_detached', 'gauge', 'Players whose socket dropped, kept for RESUME_GRACE.', 'sessions_detached'),
+    ('snake_sessions_resumed_total', 'counter', 'Reconnects that picked their player back up.', 'sessions_resumed'),
+    ('snake_sessions_expired_total', 'counter', 'Dropped players removed after RESUME_GRACE.', 'sessions_expired'),
+)
+METRIC_HISTOGRAMS = (
+    ('snake_tick_duration_milliseconds', 'Time spent in one room tick.', 'tick_duration_ms'),
+    ('snake_tick_lateness_milliseconds', 'How late room ticks start against their schedule.', 'tick_lateness_ms'),
+    ('snake_event_loop_lag_milliseconds', 'How late the event loop runs a timer.', 'loop_lag_ms'),
+    ('snake_ws_rtt_milliseconds', 'Round trip time of the latency echo connections.', 'rtt_ms'),
+)
+
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(stats):
+    # Prometheus text exposition format, built only from a ws_stats snapshot
+    lines = []
+
+    def header(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    for name, kind, help_text, key in METRICS:
+        header(name, kind, help_text)
+        lines.append(f'{name} {stats.get(key, 0)}')
+    for name, help_text, key in METRIC_HISTOGRAMS:
+        hist = stats.get(key) or snapshot_histogram(new_histogram())
+        header(name, 'histogram', help_text)
+        cumulative = 0
+        for bound, count in zip(hist['bounds'], hist['counts']):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {hist["count"]}')
+        lines.append(f'{name}_sum {hist["sum"]}')
+        lines.append(f'{name}_count {hist["count"]}')
+    header('snake_room_players', 'gauge', 'Players in each room.')
+    for room, info in stats.get('rooms', {}).items():
+        lines.append(f'snake_room_players{{room="{metric_label(room)}"}} {info["players"]}')
+    header('snake_room_bots', 'gauge', 'Server-side bots in each room.')
+    for room, info in stats.get('rooms', {}).items():
+        lines.append(f'snake_room_bots{{room="{metric_label(room)}"}} {info["bots"]}')
+    header('snake_room_spectators', 'gauge', 'Spectator sockets watching each room.')
+    for room, info in stats.get('rooms', {}).items():
+        lines.append(f'snake_room_spectators{{room="{metric_label(room)}"}} {info["spectators"]}')
+    header('snake_events_total', 'counter', 'Logged WebSocket events by type, written or not.')
+    for event, count in stats.get('events', {}).items():
+        lines.append(f'snake_events_total{{event="{metric_label(event)}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+async def spectator_handler(websocket):
+    # Watch-only connection: no player and nothing in the room's cells, so
+    # it never takes part in collisions or food. 'join' switches the room
+    # watched (and optionally the rate); anything else a player could send
+    # is ignored.
+    room = requested_room(websocket)
+    hz = spectator_hz(request_query(websocket).get('hz', [None])[0])
+    open_outbox(websocket)
+    queue_frame(websocket, json.dumps({'type': 'welcome', 'id': None, 'role': 'spectator'}))
+    async with room_locks(room):
+        watch_room(websocket, room, hz)
+    log_event('WS', 'SPECTATE', room=room, hz=hz)
+    try:
+        async for message in websocket:
+            traffic_counters['messages_in'] += 1
+            if is_echo(message):
+                await websocket.send(message)
+                continue
+            try:
+                data = json.loads(message)
+            except Exception:
+                data = None
+            if not isinstance(data, dict):
+                continue
+            mtype = data.get('type')
+            if mtype == 'ping':
+                try:
+                    await websocket.send(json.dumps({'type': 'pong', 'ts': data.get('ts')}))
+                except Exception:
+                    pass
+            elif mtype == 'join':
+                target = message_room(data, room)
+                if shard_redirect(target) is not None:
+                    await send_redirect(websocket, target)
+                    break
+                async with room_locks(room, target):
+                    unwatch_room(websocket, room, hz)
+                    hz = spectator_hz(data.get('hz'), hz)
+                    watch_room(websocket, target, hz)
+                room = target
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        close_outbox(websocket)
+        async with room_locks(room):
+            unwatch_room(websocket, room, hz)
 
 
 async def ws_handler(websocket):
-    pid = str(uuid.uuid4())
-    clients[websocket] = pid
+    if request_path(websocket) == ECHO_PATH:
+        await echo_handler(websocket)
+        return
+    if shard_redirect(requested_room(websocket)) is not None:
+        await send_redirect(websocket, requested_room(websocket))
+        return
+    if request_query(websocket).get('role', [''])[0] == 'spectator':
+        await spectator_handler(websocket)
+        return
     try:
-        remote = websocket.remote_address
+        remote = '%s:%s' % websocket.remote_address[:2]
     except Exception:
         remote = None
-    print(f"[WS] new connection pid={pid} remote={remote}")
-
-    async with state_lock:
-        rooms.setdefault('lobby', {'food': [], 'running': False})
-        players[pid] = {
-            'id': pid,
-            'name': f'Player-{pid[:4]}',
-            'snake': [[random.randrange(4, 8), random.randrange(4, 8)]],
-            'dir': [1, 0],
-            'alive': True,
-            'score': 0,
-            'color': '#{:06x}'.format(random.randint(0x444444, 0xffffff)),
-            'room': 'lobby'
-        }
+    open_outbox(websocket)
+    pid = await resume_session(websocket, request_query(websocket).get('resume', [''])[0])
+    if pid is not None:
+        token = players[pid]['token']
+        queue_frame(websocket, json.dumps({'type': 'welcome', 'id': pid, 'token': token, 'resumed': True}))
+        log_event('WS', 'RESUME', pid=pid, remote=remote, room=players[pid]['room'])
+    else:
+        pid = str(uuid.uuid4())
+        token = uuid.uuid4().hex
+        clients[websocket] = pid
+        log_event('WS', 'CONNECT', pid=pid, remote=remote)
+        first_room = requested_room(websocket)
+        queue_frame(websocket, json.dumps({'type': 'welcome', 'id': pid, 'token': token, 'resumed': False}))
+        async with state_lock, room_locks(first_room):
+            players[pid] = {
+                'id': pid,
+                'name': f'Player-{pid[:4]}',
+                'body': spawn_body(rooms[first_room], random),
+                'dir': [1, 0],
+                'inputs': deque(maxlen=INPUT_QUEUE),
+                'alive': True,
+                'score': 0,
+                'color': '#{:06x}'.format(random.randint(0x444444, 0xffffff)),
+                'room': first_room,
+                'view': (VIEW_W, VIEW_H),
+                # the socket playing it, None while within RESUME_GRACE
+                'socket': websocket,
+                'token': token,
+                'detached_at': None,
+            }
+            sessions[token] = pid
+            enter_room(pid, first_room, websocket)
+        wake_room(first_room)
+    leaving = False
 
     try:
-        await websocket.send(json.dumps({'type': 'welcome', 'id': pid}))
         async for message in websocket:
+            traffic_counters['messages_in'] += 1
+            if is_echo(message):
+                await websocket.send(message)
+                continue
             try:
                 data = json.loads(message)
             except Exception:
-                print(f"[WS] pid={pid} received invalid JSON")
+                data = None
+            if not isinstance(data, dict):
+                log_event('WS', 'BAD_JSON', pid=pid)
                 continue
             mtype = data.get('type')
             # quick ping/pong to allow client latency measurement
@@ -206,63 +2269,236 @@ async def ws_handler(websocket):
                 except Exception:
                     pass
                 continue
-            async with state_lock:
-                if mtype == 'join':
+            if players[pid]['socket'] is not websocket:
+                # taken over by a resumed connection
+                break
+            current = players[pid]['room']
+            if mtype == 'leave':
+                # a deliberate exit: no grace period to wait out
+                leaving = True
+                break
+            if mtype == 'join':
+                room = message_room(data, current)
+                if shard_redirect(room) is not None:
+                    # another worker owns the room: the client reconnects
+                    # there as a new player, so don't keep this one around
+                    await send_redirect(websocket, room)
+                    leaving = True
+                    break
+                async with room_locks(current, room):
                     players[pid]['name'] = data.get('name', players[pid]['name'])
-                    room = data.get('room')
-                    if room:
-                        players[pid]['room'] = room
-                        rooms.setdefault(room, {'food': [], 'running': False})
-                    print(f"[WS] pid={pid} JOIN room={players[pid]['room']} name={players[pid]['name']}")
-                elif mtype == 'start':
-                    room = data.get('room') or players[pid].get('room')
-                    rooms.setdefault(room, {'food': [], 'running': False})
-                    rooms[room]['running'] = True
-                    for opid, op in players.items():
-                        if op.get('room') == room:
-                            op['snake'] = [[random.randrange(4, 8), random.randrange(4, 8)]]
-                            op['dir'] = [1, 0]
-                            op['alive'] = True
-                            op['score'] = 0
-                    rooms[room]['food'] = []
-                    print(f"[WS] pid={pid} START room={room}")
-                elif mtype == 'dir':
-                    d = data.get('dir')
-                    if d == 'up':
-                        players[pid]['dir'] = [0, -1]
-                    elif d == 'down':
-                        players[pid]['dir'] = [0, 1]
-                    elif d == 'left':
-                        players[pid]['dir'] = [-1, 0]
-                    elif d == 'right':
-                        players[pid]['dir'] = [1, 0]
-                    print(f"[WS] pid={pid} DIR {d}")
+                    if room != current:
+                        leave_room(pid, websocket)
+                        target = rooms[room]
+                        if (target['w'], target['h']) != (rooms[current]['w'], rooms[current]['h']):
+                            # packed cells only mean something on a board of
+                            # the same size
+                            players[pid]['body'] = spawn_body(target, random)
+                        enter_room(pid, room, websocket)
+                    else:
+                        mark_update(rooms[room], pid, name=players[pid]['name'])
+                wake_room(current)
+                wake_room(room)
+                log_event('WS', 'JOIN', pid=pid, room=players[pid]['room'], name=players[pid]['name'])
+            elif mtype == 'start':
+                room = message_room(data, current)
+                async with room_locks(room):
+                    room_info = rooms[room]
+                    tick_ms = data.get('tick_ms')
+                    if isinstance(tick_ms, (int, float)):
+                        room_info['interval'] = min(MAX_TICK, max(MIN_TICK, tick_ms / 1000.0))
+                    seed = data.get('seed')
+                    start_room(room_info, seed if isinstance(seed, int) else None, grid_size(data.get('w'), data.get('h')))
+                wake_room(room)
+                log_event('WS', 'START', pid=pid, room=room)
+            elif mtype == 'bots':
+                # fill the current room up (or down) to this many bots
+                count = data.get('count')
+                if isinstance(count, int):
+                    async with room_locks(current):
+                        set_bots(current, count)
+                    wake_room(current)
+                    log_event('WS', 'BOTS', pid=pid, room=current, count=count)
+            elif mtype == 'view':
+                # cells the client shows around its head on a big board
+                players[pid]['view'] = view_size(data.get('w'), data.get('h'))
+            elif mtype == 'dir':
+                d = data.get('dir')
+                queue_input(players[pid], d)
+                log_event('WS', 'DIR', pid=pid, dir=d)
+            elif mtype == 'resync':
+                async with room_locks(current):
+                    room_info = rooms[current]
+                    if websocket in room_info['sockets']:
+                        room_info['need_key'].add(websocket)
+                wake_room(current)
     except websockets.exceptions.ConnectionClosed:
         pass
     except Exception as e:
-        print(f"[WS] pid={pid} handler exception: {e}")
+        log_event('WS', 'HANDLER_ERROR', pid=pid, error=e)
     finally:
-        print(f"[WS] connection closed pid={pid}")
+        log_event('WS', 'CLOSE', pid=pid)
+        close_outbox(websocket)
         try:
-            async with state_lock:
-                if websocket in clients:
+            room = players[pid]['room'] if pid in players else None
+            async with state_lock, room_locks(*([room] if room else [])):
+                if clients.get(websocket) == pid:
                     del clients[websocket]
-                if pid in players:
-                    del players[pid]
+                p = players.get(pid)
+                if p is not None and p['socket'] is websocket:
+                    if leaving:
+                        leave_room(pid, websocket)
+                        del players[pid]
+                        sessions.pop(p['token'], None)
+                    else:
+                        # kept, snake and all, for resume_session()
+                        detach_socket(rooms[room], websocket)
+                        p['socket'] = None
+                        p['detached_at'] = time.monotonic()
+            if room:
+                wake_room(room)
         except Exception:
             pass
 
 
-async def ws_main(port=6789):
-    print(f"Starting WebSocket server on 0.0.0.0:{port}")
-    server = await websockets.serve(ws_handler, '0.0.0.0', port)
-    await game_loop()
+def request_target(websocket):
+    request = getattr(websocket, 'request', None)
+    return urlsplit(getattr(request, 'path', None) or getattr(websocket, 'path', None) or '')
+
+
+def request_path(websocket):
+    return request_target(websocket).path
+
+
+def request_query(websocket):
+    return parse_qs(request_target(websocket).query)
+
+
+def message_room(data, default):
+    # the room a message names, or `default` if it names none; anything
+    # but a non-empty string doesn't count as a name
+    room = data.get('room')
+    return room if isinstance(room, str) and room else default
+
+
+def requested_room(websocket):
+    # ws://host:port/?room=name starts the player out in that room, which is
+    # how a redirected client lands in a room its new worker owns
+    return request_query(websocket).get('room', [''])[0] or 'lobby'
+
+
+async def ws_main(port=6789, host='0.0.0.0', process_request=None):
+    print(f"Starting WebSocket server on {host}:{port}")
+    server = await websockets.serve(ws_handler, host, port, select_subprotocol=select_subprotocol,
+                                    process_request=process_request)
+    await stats_loop()
+    await server.wait_closed()
+
+
+# Sharded mode: `python server.py --workers N` starts N worker processes,
+# each running ws_main on a port of its own, and a router on the public
+# port. Every room lives on exactly one worker (shard_for_room). Frames
+# never go through the router: it answers each game connection with a
+# 'redirect' naming the port of the worker that owns the requested room,
+# and clients reconnect there directly (same host, same query). A worker
+# does the same for a 'join' into a room another worker owns, so fan-out
+# runs on every worker's core instead of the router's. Worker ports are
+# --worker-port, --worker-port + 1, ... when given, so they can be opened
+# in a firewall or proxied; --worker-url adds the full URL a client should
+# use instead, e.g. wss://example.com/w{shard} behind a TLS proxy.
+worker_ports = []
+# this process's index into worker_ports; None in the router
+worker_shard = None
+# format string with {shard} and {port}, see above
+worker_url = None
+
+
+def shard_for_room(room, shards):
+    return zlib.crc32(room.encode('utf-8')) % shards
+
+
+def shard_redirect(room):
+    # the port of the worker that owns `room` when that isn't this process,
+    # else None
+    if not worker_ports:
+        return None
+    shard = shard_for_room(room, len(worker_ports))
+    return None if shard == worker_shard else worker_ports[shard]
+
+
+def redirect_message(room):
+    port = shard_redirect(room)
+    message = {'type': 'redirect', 'port': port, 'room': room}
+    if worker_url:
+        message['url'] = worker_url.format(shard=worker_ports.index(port), port=port)
+    return message
+
+
+async def send_redirect(websocket, room):
+    message = redirect_message(room)
+    log_event('WS', 'REDIRECT', room=room, port=message['port'])
+    try:
+        await websocket.send(json.dumps(message))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def router_handler(client):
+    # latency checks are answered by the router itself, no worker involved
+    if request_path(client) == ECHO_PATH:
+        await echo_handler(client)
+        return
+    await send_redirect(client, requested_room(client))
+
+
+async def router_main(port, host='0.0.0.0', process_request=None):
+    print(f"Starting WebSocket router on {host}:{port} for workers {worker_ports}")
+    server = await websockets.serve(router_handler, host, port, select_subprotocol=select_subprotocol,
+                                    process_request=process_request)
+    asyncio.create_task(pull_leaderboards())
+    asyncio.create_task(pull_worker_stats())
+    await stats_loop()
     await server.wait_closed()
 
 
+def run_worker(shard, ports, url, board_path, level):
+    # Everything a worker needs from the router process comes in as
+    # arguments, since under the spawn and forkserver start methods the
+    # child starts from a fresh import of this module.
+    global worker_shard, worker_url, leaderboard_path, log_level
+    worker_ports[:] = ports
+    worker_shard = shard
+    worker_url = url
+    leaderboard_path = board_path
+    log_level = level
+    port = ports[shard]
+    if leaderboard_path:
+        # each worker keeps the boards of the rooms it owns in its own file
+        root, ext = os.path.splitext(leaderboard_path)
+        load_leaderboard(f'{root}-{shard}{ext}')
+    try:
+        asyncio.run(ws_main(port=port, process_request=worker_http))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(count, base_port=None, url=None):
+    global worker_url
+    worker_url = url
+    # every worker needs the whole list to redirect joins to the others
+    for shard in range(count):
+        worker_ports.append(base_port + shard if base_port else find_free_port(preferred=()))
+    for shard in range(count):
+        multiprocessing.Process(target=run_worker, daemon=True,
+                                args=(shard, list(worker_ports), worker_url, leaderboard_path, log_level)).start()
+
+
 def find_free_port(preferred=(6789, 6790)):
     for p in preferred:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            # match the listening socket asyncio creates, so connections
+            # left in TIME_WAIT by a previous run don't make the port look taken
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
                 s.bind(('0.0.0.0', p))
                 return p
@@ -273,26 +2509,167 @@ def find_free_port(preferred=(6789, 6790)):
         return s.getsockname()[1]
 
 
-def start_ws_server():
-    port = find_free_port()
+# Single-port mode (--single-port): the websockets server answers plain
+# HTTP requests too, through process_http(), so pages and the game socket
+# share one port and one event loop and there is no Flask dev server. Any
+# request without an Upgrade header goes through the Flask app; the pages
+# in CACHED_PAGES are rendered once per Host and then served from
+# page_cache with an ETag (304 on If-None-Match) and a gzipped body for
+# clients that accept it.
+CACHED_PAGES = {'/', '/game', '/snake', '/snakes'}
+# Host header values are up to the client, so the cache is simply emptied
+# when it gets this big
+PAGE_CACHE_SIZE = 64
+page_cache = {}
+
+
+def flask_response(ws_request):
+    environ = EnvironBuilder(path=ws_request.path, headers=list(ws_request.headers.raw_items())).get_environ()
+    with app.request_context(environ):
+        return app.full_dispatch_request()
+
+
+def http_response(status, headers, body=b''):
+    # Headers appends on assignment, and Flask's headers already carry
+    # these; a doubled Content-Length gets the response rejected by proxies
+    for name in ('Content-Length', 'Connection'):
+        if name in headers:
+            del headers[name]
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'close'
+    return WsResponse(status, http.HTTPStatus(status).phrase, headers, body)
+
+
+def cached_page(ws_request, path):
+    # the page embeds ws_base(), which depends on both of these
+    key = (path, ws_request.headers.get('Host', ''), ws_request.headers.get('X-Forwarded-Proto', ''))
+    page = page_cache.get(key)
+    if page is None:
+        response = flask_response(ws_request)
+        if response.status_code != 200:
+            return http_response(response.status_code, Headers(response.headers.items()), response.get_data())
+        body = response.get_data()
+        if len(page_cache) >= PAGE_CACHE_SIZE:
+            page_cache.clear()
+        page = page_cache[key] = {
+            'etag': '"%s"' % hashlib.sha1(body).hexdigest()[:20],
+            'type': response.headers['Content-Type'],
+            'body': body,
+            'gzip': gzip.compress(body),
+        }
+    headers = Headers()
+    headers['ETag'] = page['etag']
+    headers['Cache-Control'] = 'no-cache'
+    headers['Vary'] = 'Accept-Encoding'
+    if page['etag'] in ws_request.headers.get('If-None-Match', ''):
+        return http_response(304, headers)
+    headers['Content-Type'] = page['type']
+    if 'gzip' in ws_request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return http_response(200, headers, page['gzip'])
+    return http_response(200, headers, page['body'])
+
+
+def cached_leaderboard(ws_request):
+    # /api/leaderboard without going through Flask, since it's polled and
+    # this runs on the loop every room ticks on; same answers as the route
+    cached = leaderboard_cache
+    headers = Headers()
+    headers['ETag'] = cached['etag']
+    headers['Cache-Control'] = 'no-cache'
+    headers['Vary'] = 'Accept-Encoding'
+    if cached['etag'] in ws_request.headers.get('If-None-Match', ''):
+        return http_response(304, headers)
+    headers['Content-Type'] = 'application/json'
+    if 'gzip' in ws_request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return http_response(200, headers, cached['gzip'])
+    return http_response(200, headers, cached['body'])
+
+
+def process_http(connection, ws_request):
+    if ws_request.headers.get('Upgrade', '').lower() == 'websocket':
+        return None
+    path = urlsplit(ws_request.path).path
+    if path in CACHED_PAGES:
+        return cached_page(ws_request, path)
+    if path == LEADERBOARD_PATH:
+        return cached_leaderboard(ws_request)
+    response = flask_response(ws_request)
+    return http_response(response.status_code, Headers(response.headers.items()), response.get_data())
+
+
+def start_ws_server(preferred=(6789, 6790), process_request=None):
+    port = find_free_port(preferred)
     global websocket_port
     websocket_port = port
     try:
         ws_ver = getattr(websockets, '__version__', 'unknown')
     except Exception:
         ws_ver = 'unknown'
-    print(f"Starting WebSocket server on port {port} (preferred 6789/6790) - websockets v{ws_ver}")
+    print(f"Starting WebSocket server on port {port} (preferred {'/'.join(map(str, preferred))}) - websockets v{ws_ver}")
     try:
-        asyncio.run(ws_main(port=port))
+        if worker_ports:
+            asyncio.run(router_main(port=port, process_request=process_request))
+        else:
+            asyncio.run(ws_main(port=port, process_request=process_request))
     except OSError as e:
         print(f"Failed to start WebSocket server on port {port}: {e}")
 
 
-def start_servers():
-    ws_thread = threading.Thread(target=start_ws_server, daemon=True)
-    ws_thread.start()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+def start_servers(workers=1, ws_port=None, http=True, one_port=False, worker_port=None, worker_url=None):
+    global single_port
+    if workers > 1:
+        start_workers(workers, worker_port, worker_url)
+        # the router's boards are only ever merged from the workers'
+        load_leaderboard(None)
+    if one_port:
+        single_port = True
+        start_ws_server((ws_port or 8000,), process_request=process_http)
+        return
+    preferred = (ws_port,) if ws_port else (6789, 6790)
+    if not http:
+        start_ws_server(preferred)
+        return
+    # the reloader would start a second copy of every worker process
+    use_reloader = workers <= 1
+    # with the reloader on, this runs both in the process that watches the
+    # files and in the child it starts to serve; only the child should
+    # take the game port
+    if not use_reloader or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ws_thread = threading.Thread(target=start_ws_server, args=(preferred,), daemon=True)
+        ws_thread.start()
+    app.run(debug=True, use_reloader=use_reloader, host='0.0.0.0', port=5000)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Flask pages and the multiplayer snake WebSocket server.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='game worker processes; above 1, rooms are sharded across them behind a router')
+    parser.add_argument('--ws-port', type=int, default=None,
+                        help='public WebSocket port (default: 6789, or 6790 if taken)')
+    parser.add_argument('--worker-port', type=int, default=None, metavar='BASE',
+                        help='with --workers, worker i listens on BASE + i (default: any free port); '
+                             'clients are redirected to these, so they must be reachable')
+    parser.add_argument('--worker-url', default=None, metavar='TEMPLATE',
+                        help='with --workers, the URL clients are redirected to instead of the worker port on '
+                             'the same host, with {shard} and {port} filled in, e.g. wss://example.com/w{shard}')
+    parser.add_argument('--no-http', action='store_true',
+                        help='run only the WebSocket side, without the Flask pages')
+    parser.add_argument('--single-port', action='store_true',
+                        help='serve the pages and the game socket together on --ws-port (default 8000), '
+                             'without the Flask dev server')
+    parser.add_argument('--leaderboard', default='leaderboard.json', metavar='PATH',
+                        help='file the leaderboard is kept in ("" to keep it in memory only); '
+                             'with --workers, one file per worker')
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default='info',
+                        help='lowest event level written to stdout; every event is counted in /api/ws-stats either way')
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
-    start_servers()
\ No newline at end of file
+    args = parse_args()
+    log_level = LOG_LEVELS[args.log_level]
+    load_leaderboard(args.leaderboard or None)
+    start_servers(workers=args.workers, ws_port=args.ws_port, http=not args.no_http, one_port=args.single_port,
+                  worker_port=args.worker_port, worker_url=args.worker_url)
\ No newline at end of file
@@ -0,0 +1,545 @@
+"""Micro-benchmarks for the snake game server in server.py.
+
+Run with `python snake_bench.py` (or `python snake_bench.py tick` to run a
+single section). Nothing here opens a socket; the game state is built
+directly in the server module's dicts.
+"""
+import asyncio
+import gc
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from websockets.protocol import State
+from websockets.server import ServerProtocol
+
+import server
+
+TICKS = 50
+
+
+def make_room(room_name, snakes, length):
+    # one horizontal snake per row, heads pointing right with enough room to
+    # keep moving for TICKS steps without touching the wall
+    server.GRID_W = length + TICKS + 2
+    server.GRID_H = snakes + 2
+    server.players.clear()
+    server.rooms.clear()
+    room_info = server.new_room()
+    room_info['running'] = True
+    # these sections time the shared frames every socket gets, so the board
+    # stays unbucketed however wide it is (see bench_viewport for the rest)
+    room_info['snake_buckets'] = room_info['food_buckets'] = None
+    server.rooms[room_name] = room_info
+    for i in range(snakes):
+        pid = f'bot-{i}'
+        y = i + 1
+        body = server.new_body(server.cell_index(x, y, server.GRID_W) for x in range(length, 0, -1))
+        server.players[pid] = {
+            'id': pid,
+            'name': pid,
+            'body': body,
+            'dir': [1, 0],
+            'inputs': deque(maxlen=server.INPUT_QUEUE),
+            'alive': True,
+            'score': 0,
+            'color': '#66d9e8',
+            'room': room_name,
+        }
+        server.enter_room(pid, room_name)
+    return room_info
+
+
+def bench_tick():
+    print('tick: step_room cost as snake count and length grow')
+    print(f"{'snakes':>8} {'length':>8} {'ms/tick':>10} {'us/snake':>10}")
+    for snakes in (10, 50, 200):
+        for length in (10, 100, 400):
+            room_info = make_room('bench', snakes, length)
+            t0 = time.perf_counter()
+            for _ in range(TICKS):
+                server.step_room('bench', room_info)
+            elapsed = (time.perf_counter() - t0) / TICKS
+            print(f'{snakes:>8} {length:>8} {elapsed * 1000:>10.3f} {elapsed * 1e6 / snakes:>10.2f}')
+
+
+class SlowSocket:
+    # stands in for a websocket whose send() takes `delay` seconds to drain
+    def __init__(self, delay):
+        self.delay = delay
+
+    async def send(self, data):
+        await asyncio.sleep(self.delay)
+
+
+async def _bench_broadcast(sockets, delay):
+    room_info = make_room('bench', 20, 20)
+    for i in range(sockets):
+        ws = SlowSocket(delay)
+        room_info['sockets'][ws] = f'bot-{i % 20}'
+        server.open_outbox(ws)
+    # sequential awaits, which is how broadcast_room_state used to send
+    data = server.encode_keyframe('bench', room_info)
+    t0 = time.perf_counter()
+    for ws in list(room_info['sockets']):
+        await ws.send(data)
+    sequential = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    server.broadcast_room_state('bench')
+    fanout = time.perf_counter() - t0
+    for ws in list(server.outboxes):
+        server.close_outbox(ws)
+    return sequential, fanout
+
+
+def bench_broadcast():
+    print('broadcast: time the tick spends sending one frame to a room')
+    print(f"{'sockets':>8} {'send ms':>8} {'sequential ms':>14} {'fan-out ms':>11}")
+    for sockets in (10, 50, 200):
+        for delay in (0.0, 0.005):
+            sequential, fanout = asyncio.run(_bench_broadcast(sockets, delay))
+            print(f'{sockets:>8} {delay * 1000:>8.1f} {sequential * 1000:>14.3f} {fanout * 1000:>11.3f}')
+
+
+def _time_encode(encoder, room_info, repeat=200):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        data = encoder('bench', room_info)
+    return len(data), (time.perf_counter() - t0) / repeat
+
+
+def bench_wire():
+    print('wire: bytes and encode time per frame, JSON vs snake.bin.v2')
+    print(f"{'snakes':>8} {'length':>8} {'frame':>6} {'json B':>9} {'bin B':>9} {'json us':>9} {'bin us':>9}")
+    for snakes in (4, 20, 100):
+        for length in (5, 50):
+            room_info = make_room('bench', snakes, length)
+            # a typical tick: every snake moves, one eats, food respawns
+            server.broadcast_room_state('bench')
+            server.step_room('bench', room_info)
+            server.add_food(room_info, [0, 0])
+            server.prune_delta(room_info['delta'])
+            for kind in ('key', 'delta'):
+                json_bytes, json_time = _time_encode(server.ENCODERS[(kind, 'json')], room_info)
+                bin_bytes, bin_time = _time_encode(server.ENCODERS[(kind, 'bin')], room_info)
+                print(f'{snakes:>8} {length:>8} {kind:>6} {json_bytes:>9} {bin_bytes:>9} '
+                      f'{json_time * 1e6:>9.1f} {bin_time * 1e6:>9.1f}')
+
+
+class NullSocket:
+    subprotocol = None
+
+    async def send(self, data):
+        pass
+
+
+class BroadcastSocket(NullSocket):
+    # enough of a websockets connection for websockets.broadcast(): frames
+    # are really built by the protocol, then thrown away instead of written
+    send_in_progress = None
+
+    def __init__(self):
+        self.protocol = ServerProtocol()
+        self.protocol.state = State.OPEN
+        self.transport = self
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def send_data(self):
+        self.protocol.data_to_send()
+
+
+async def _bench_budget(snakes, binary):
+    room_info = make_room('bench', snakes, 20)
+    for pid in room_info['members']:
+        ws = NullSocket()
+        if binary:
+            ws.subprotocol = server.BINARY_SUBPROTOCOL
+        room_info['sockets'][ws] = pid
+        server.open_outbox(ws)
+    total = 0.0
+    for _ in range(TICKS):
+        t0 = time.perf_counter()
+        server.tick_room('bench', room_info)
+        total += time.perf_counter() - t0
+        await asyncio.sleep(0)  # let the writers drain
+    for ws in list(server.outboxes):
+        server.close_outbox(ws)
+    return total / TICKS
+
+
+def bench_budget():
+    print(f'budget: full room tick (food, step, encode, queue) vs the {server.TICK * 1000:.0f} ms tick')
+    print(f"{'players':>8} {'format':>7} {'ms/tick':>9} {'% budget':>9}")
+    for snakes in (25, 100, 400, 1000):
+        for binary in (False, True):
+            elapsed = asyncio.run(_bench_budget(snakes, binary))
+            fmt = 'bin' if binary else 'json'
+            print(f'{snakes:>8} {fmt:>7} {elapsed * 1000:>9.3f} {elapsed / server.TICK * 100:>8.1f}%')
+
+
+async def _bench_audience(watchers, hz=None):
+    room_info = make_room('bench', 50, 20)
+    server.rooms['bench'] = room_info
+    for pid in room_info['members']:
+        ws = NullSocket()
+        room_info['sockets'][ws] = pid
+        server.open_outbox(ws)
+    for i in range(watchers):
+        if hz:
+            ws = BroadcastSocket()
+            room_info['audience'].setdefault(hz, {}).setdefault('json', set()).add(ws)
+        else:
+            # the old way to watch: a socket in the room getting every frame
+            ws = NullSocket()
+            server.open_outbox(ws)
+            room_info['sockets'][ws] = 'bot-0'
+    # ticks are timed together with the outbox writers draining, which is
+    # where most of a full-rate watcher's cost goes; the previous run's
+    # garbage is collected first so it doesn't land in this one's ticks
+    gc.collect()
+    worst = 0.0
+    t0 = time.perf_counter()
+    for _ in range(TICKS):
+        t = time.perf_counter()
+        server.tick_room('bench', room_info)
+        await asyncio.sleep(0)
+        worst = max(worst, time.perf_counter() - t)
+    elapsed = time.perf_counter() - t0
+    # spectators get their keyframes from their rate's task instead, in
+    # batches between which the rooms can tick
+    push = 0.0
+    if hz:
+        t = time.perf_counter()
+        await server.push_spectators('bench', room_info, hz)
+        push = time.perf_counter() - t
+    for ws in list(server.outboxes):
+        server.close_outbox(ws)
+    server.rooms.clear()
+    return elapsed / TICKS, worst, push
+
+
+def bench_audience():
+    print(f'audience: ms per {server.TICK * 1000:.0f} ms tick (average and slowest) for 50 players plus N watchers,')
+    print(f'as full-rate sockets or as 4 Hz spectators, and ms to push one spectator keyframe to all of them')
+    print(f"{'watchers':>9} {'full':>9} {'full max':>9} {'spect':>9} {'spect max':>9} {'push':>9} {'per batch':>9}")
+    for watchers in (0, 100, 1000, 10000):
+        full, full_worst, _ = asyncio.run(_bench_audience(watchers))
+        spect, spect_worst, push = asyncio.run(_bench_audience(watchers, 4))
+        batches = max(1, -(-watchers // server.SPECTATOR_BATCH))
+        cells = (full, full_worst, spect, spect_worst, push, push / batches)
+        print(f'{watchers:>9} ' + ' '.join(f'{ms * 1000:>9.3f}' for ms in cells))
+
+
+def make_big_room(room_name, size, viewers):
+    # a size x size board with one 10-cell snake per 50x50 cells, dropped at
+    # random, and food at the density tick_room keeps; the first `viewers`
+    # snakes have a binary socket
+    server.players.clear()
+    server.rooms.clear()
+    room_info = server.rooms[room_name] = server.new_room(1, size, size)
+    room_info['running'] = True
+    rng = random.Random(1)
+    sockets = []
+    for i in range(max(viewers, size * size // 2500)):
+        pid = f'bot-{i}'
+        x, y = rng.randrange(12, size - 12), rng.randrange(1, size - 1)
+        server.players[pid] = {
+            'id': pid,
+            'name': pid,
+            'body': server.new_body(server.cell_index(x - j, y, size) for j in range(10)),
+            'dir': [1, 0],
+            'inputs': deque(maxlen=server.INPUT_QUEUE),
+            'alive': True,
+            'score': 0,
+            'color': '#66d9e8',
+            'room': room_name,
+            'view': (server.VIEW_W, server.VIEW_H),
+        }
+        ws = None
+        if i < viewers:
+            ws = NullSocket()
+            ws.subprotocol = server.BINARY_SUBPROTOCOL
+            server.open_outbox(ws)
+            sockets.append(ws)
+        server.enter_room(pid, room_name, ws)
+    return room_info, sockets
+
+
+async def _bench_viewport(size, viewers):
+    room_info, sockets = make_big_room('bench', size, viewers)
+    server.tick_room('bench', room_info)  # food, and a keyframe for every view
+    server.step_room('bench', room_info)
+    server.prune_delta(room_info['delta'])
+    board_key = len(server.encode_keyframe_bin('bench', room_info))
+    board_delta, board_time = _time_encode(server.encode_delta_bin, room_info, 20)
+    members = room_info['members']
+    views = [(members[room_info['sockets'][ws]], room_info['views'][ws]) for ws in sockets]
+    view_key = sum(len(server.encode_keyframe_bin('bench', server.view_frame(
+        room_info, 'key', server.body_head(p['body']), p['view'], server.new_view(), p['id']))) for p, _ in views)
+    # view_frame() moves each view on, so time it against copies
+    copies = [(p, {'pids': set(v['pids']), 'food': set(v['food'])}) for p, v in views]
+    view_delta = 0
+    t0 = time.perf_counter()
+    for p, v in copies:
+        info = server.view_frame(room_info, 'delta', server.body_head(p['body']), p['view'], v, p['id'])
+        view_delta += len(server.encode_delta_bin('bench', info))
+    view_time = (time.perf_counter() - t0) / viewers
+    for ws in sockets:
+        server.close_outbox(ws)
+    return (len(members), len(room_info['food']), board_key, view_key // viewers,
+            board_delta, view_delta // viewers, board_time, view_time)
+
+
+def bench_viewport():
+    print(f'viewport: binary bytes and encode time per client, whole board vs a {server.VIEW_W}x{server.VIEW_H} view')
+    print(f"{'board':>6} {'snakes':>7} {'food':>6} {'board key B':>12} {'view key B':>11} "
+          f"{'board delta B':>14} {'view delta B':>13} {'board us':>9} {'view us':>8}")
+    for size in (100, 300, 1000):
+        snakes, food, board_key, view_key, board_delta, view_delta, board_time, view_time = \
+            asyncio.run(_bench_viewport(size, 20))
+        print(f'{size:>6} {snakes:>7} {food:>6} {board_key:>12} {view_key:>11} '
+              f'{board_delta:>14} {view_delta:>13} {board_time * 1e6:>9.1f} {view_time * 1e6:>8.1f}')
+
+
+def time_planner(room_info, use_numpy):
+    saved = server.np
+    if not use_numpy:
+        server.np = None
+    try:
+        t0 = time.perf_counter()
+        server.plan_bots(room_info)
+        return time.perf_counter() - t0
+    finally:
+        server.np = saved
+
+
+def bench_bots():
+    # a started 100x100 room full of bots, timed on the same states with and
+    # without NumPy; the match itself is played by whichever is installed
+    print(f'bots: plan_bots() per tick on a 100x100 board, and as % of the {server.TICK * 1000:.0f} ms tick')
+    print(f"{'bots':>5} {'numpy ms':>9} {'%':>5} {'python ms':>10} {'%':>6} {'tick ms':>8}")
+    budget = server.TICK * 1000
+    # past the cap the server puts on bots without NumPy, to show why it's there
+    server.MAX_BOTS_PYTHON = server.MAX_BOTS
+    for count in (10, 50, 100, 200):
+        server.players.clear()
+        server.rooms.clear()
+        random.seed(1)
+        room_info = server.rooms['bots'] = server.new_room(1, 100, 100)
+        server.set_bots('bots', count)
+        server.start_room(room_info, 1)
+        for _ in range(TICKS):
+            server.tick_room('bots', room_info)
+        vectorized = plain = ticked = 0.0
+        samples = 10
+        for _ in range(samples):
+            if server.np is not None:
+                vectorized += time_planner(room_info, True)
+            plain += time_planner(room_info, False)
+            t0 = time.perf_counter()
+            server.tick_room('bots', room_info)
+            ticked += time.perf_counter() - t0
+        numpy_ms = vectorized / samples * 1000 if server.np is not None else float('nan')
+        python_ms = plain / samples * 1000
+        print(f'{count:>5} {numpy_ms:>9.2f} {numpy_ms / budget * 100:>5.1f} {python_ms:>10.2f} '
+              f'{python_ms / budget * 100:>6.1f} {ticked / samples * 1000:>8.2f}')
+
+
+def bench_leaderboard():
+    # every room's board full, then scores that do and don't make a board
+    print(f'leaderboard: top-{server.LEADERBOARD_SIZE} updates, publishing and /api/leaderboard polling')
+    server.load_leaderboard(None)
+    rooms = [f'room-{i}' for i in range(server.LEADERBOARD_ROOMS)]
+    for i in range(server.LEADERBOARD_ROOMS * server.LEADERBOARD_SIZE):
+        server.leaderboard_score(rooms[i % len(rooms)], f'p{i}', f'p{i}', 1000 + i % 997)
+    server.publish_leaderboard()
+    rounds = 100000
+    for label, score in (('score off board', 1), ('score on board', 10 ** 6)):
+        t0 = time.perf_counter()
+        for i in range(rounds):
+            server.leaderboard_score(rooms[i % len(rooms)], f'q{i}', 'q', score + i)
+        print(f'{label:>16}: {(time.perf_counter() - t0) / rounds * 1e6:.2f} us')
+    dirty = len(server.leaderboards['dirty'])
+    t0 = time.perf_counter()
+    server.publish_leaderboard()
+    body = server.leaderboard_cache
+    print(f'         publish: {(time.perf_counter() - t0) * 1000:.1f} ms for {dirty} changed rooms, '
+          f'{len(body["body"])} B ({len(body["gzip"])} B gzipped)')
+    client = server.app.test_client()
+    for label, headers in (('200 gzip', {'Accept-Encoding': 'gzip'}), ('304', {'If-None-Match': body['etag']})):
+        t0 = time.perf_counter()
+        for _ in range(2000):
+            client.get('/api/leaderboard', headers=headers)
+        print(f'{label:>16}: {2000 / (time.perf_counter() - t0):.0f} requests/s (Flask test client)')
+
+
+def rejection_sample(room_info):
+    # the old random_empty_cell: up to 200 random tries, then give up and
+    # return a cell that may well be occupied
+    for _ in range(200):
+        x = random.randrange(1, server.GRID_W - 1)
+        y = random.randrange(1, server.GRID_H - 1)
+        idx = server.cell_index(x, y, server.GRID_W)
+        if idx not in room_info['cells'] and idx not in room_info['food_cells']:
+            return [x, y]
+    return [random.randrange(1, server.GRID_W - 1), random.randrange(1, server.GRID_H - 1)]
+
+
+def bench_spawn():
+    print('spawn: picking a food cell as the board fills up')
+    print(f"{'full %':>7} {'reject us':>10} {'reject bad':>11} {'free-set us':>12} {'free-set bad':>13}")
+    repeat = 2000
+    for fill in (0.0, 0.5, 0.9, 0.95, 0.99):
+        server.GRID_W, server.GRID_H = 28, 20
+        server.rooms.clear()
+        room_info = server.rooms['bench'] = server.new_room()
+        interior = [server.cell_index(x, y, server.GRID_W) for y in range(1, server.GRID_H - 1) for x in range(1, server.GRID_W - 1)]
+        random.shuffle(interior)
+        server.occupy_snake(room_info, 'wall', server.new_body(interior[:int(len(interior) * fill)]))
+        results = []
+        for sampler in (lambda: rejection_sample(room_info), lambda: server.random_empty_cell('bench')):
+            bad = 0
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                x, y = sampler()
+                bad += server.cell_index(x, y, server.GRID_W) in room_info['cells']
+            results += [(time.perf_counter() - t0) / repeat * 1e6, bad]
+        print(f'{fill * 100:>7.0f} {results[0]:>10.2f} {results[1]:>11} {results[2]:>12.2f} {results[3]:>13}')
+
+
+def deep_size(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(v) for v in obj.values())
+    elif isinstance(obj, list):
+        size += sum(deep_size(v) for v in obj)
+    elif isinstance(obj, memoryview):
+        size += obj.nbytes
+    return size
+
+
+def bench_body():
+    print('body: snake body as [x, y] lists vs the ring buffer')
+    print(f"{'length':>8} {'list B':>10} {'ring B':>10} {'list move us':>13} {'ring move us':>13}")
+    server.GRID_W, server.GRID_H = 1000, 1000
+    moves = 20000
+    for length in (10, 100, 1000, 10000):
+        snake = [[x % 1000, x // 1000] for x in range(length)]
+        body = server.new_body(range(length))
+        t0 = time.perf_counter()
+        for i in range(moves):
+            snake.insert(0, [i % 1000, 500])
+            snake.pop()
+        list_us = (time.perf_counter() - t0) / moves * 1e6
+        t0 = time.perf_counter()
+        for i in range(moves):
+            server.body_push(body, 500000 + i % 1000)
+            server.body_pop(body)
+        ring_us = (time.perf_counter() - t0) / moves * 1e6
+        print(f'{length:>8} {deep_size(snake):>10} {deep_size(body):>10} {list_us:>13.3f} {ring_us:>13.3f}')
+
+
+class ScriptedSocket:
+    # a client that sends `messages` as fast as the handler reads them
+    subprotocol = None
+    remote_address = ('127.0.0.1', 0)
+    request = None
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def __aiter__(self):
+        for message in self.messages:
+            yield message
+
+    async def send(self, data):
+        pass
+
+    async def close(self, code=1000, reason=''):
+        pass
+
+
+def print_event(component, event, **fields):
+    # what the handler used to do: format and print every event inline
+    print(f"[{component}] {event} " + ' '.join(f'{k}={v}' for k, v in fields.items()))
+
+
+async def _bench_logging(messages):
+    server.GRID_W, server.GRID_H = 28, 20
+    server.players.clear()
+    server.rooms.clear()
+    t0 = time.perf_counter()
+    await server.ws_handler(ScriptedSocket(messages))
+    elapsed = time.perf_counter() - t0
+    for room_info in server.rooms.values():
+        if room_info['task']:
+            room_info['task'].cancel()
+    return elapsed
+
+
+def run_logging_modes(messages, pause):
+    # stdout becomes a line-buffered pipe drained by another thread, so each
+    # print is a real write() the way it is on a terminal; with `pause` the
+    # reader sleeps after every 4 KB, like a slow terminal or a busy pager
+    read_fd, write_fd = os.pipe()
+
+    def drain():
+        while os.read(read_fd, 4096):
+            time.sleep(pause)
+    threading.Thread(target=drain, daemon=True).start()
+    saved = sys.stdout, server.log_event, server.log_level, server.LOG_EVENTS['DIR']
+    sys.stdout = os.fdopen(write_fd, 'w', buffering=1)
+    modes = (
+        # every DIR written, so the queue and not the sampling is measured
+        ('print', print_event, 'debug', ('debug', 1.0)),
+        ('logger, debug', server.log_event, 'debug', ('debug', 1.0)),
+        ('logger, info', server.log_event, 'info', saved[3]),
+    )
+    results = {}
+    try:
+        for mode, logger, level, dir_config in modes:
+            server.log_event, server.log_level = logger, server.LOG_LEVELS[level]
+            server.LOG_EVENTS['DIR'] = dir_config
+            results[mode] = asyncio.run(_bench_logging(messages))
+    finally:
+        sys.stdout.close()
+        sys.stdout, server.log_event, server.log_level, server.LOG_EVENTS['DIR'] = saved
+    return results
+
+
+def bench_logging():
+    print('logging: ws_handler throughput on a stream of dir messages, msgs/s')
+    print(f"{'mode':>16} {'fast reader':>12} {'slow reader':>12}")
+    turns = ('up', 'left', 'down', 'right')
+    messages = [f'{{"type": "dir", "dir": "{turns[i % 4]}"}}' for i in range(20000)]
+    fast = run_logging_modes(messages, 0.0)
+    slow = run_logging_modes(messages, 0.01)
+    for mode in fast:
+        print(f'{mode:>16} {len(messages) / fast[mode]:>12.0f} {len(messages) / slow[mode]:>12.0f}')
+
+
+BENCHES = {
+    'tick': bench_tick,
+    'broadcast': bench_broadcast,
+    'wire': bench_wire,
+    'budget': bench_budget,
+    'audience': bench_audience,
+    'viewport': bench_viewport,
+    'bots': bench_bots,
+    'leaderboard': bench_leaderboard,
+    'spawn': bench_spawn,
+    'body': bench_body,
+    'logging': bench_logging,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
+        print()
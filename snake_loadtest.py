@@ -0,0 +1,241 @@
+"""Load generator and latency benchmark for the snake server in server.py.
+
+Opens N simulated clients spread over M rooms against ws_main, starts every
+room and keeps sending random directions. One client per room records
+every frame it receives and pings the server with the existing ping/pong
+messages. Everything runs on localhost. With --workers it launches
+`server.py --no-http` once per worker count and runs the same load
+against each, e.g.
+
+    python snake_loadtest.py --workers 1,2,4 --clients 400 --rooms 80
+
+Point it at an already running server with --url instead (server CPU is
+then not reported).
+
+Reported per run:
+  on tick    rooms whose median frame gap stays within 1.2 ticks
+  jitter     standard deviation of the gap between consecutive frames
+  frame      how late each frame arrives compared with an ideal TICK
+             schedule fitted to the room's earliest frames, p50/p99
+  rtt        ping/pong round trip, p50/p99
+  KB/s       bytes received by all clients together
+  cpu        CPU used by the server processes, as % of one core
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+import websockets
+
+import server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PING_EVERY = 0.5
+
+
+def new_recording():
+    return {'arrivals': [], 'rtts': [], 'bytes': 0}
+
+
+async def connect_room(url, room, protocol):
+    # a sharded server's router answers with a 'redirect' to the worker that
+    # owns the room; follow it, so the frames come from the worker directly
+    parts = urlsplit(url)._replace(path='/', query=urlencode({'room': room}))
+    while True:
+        ws = await websockets.connect(urlunsplit(parts), subprotocols=[protocol], max_queue=None)
+        first = json.loads(await ws.recv())
+        if first.get('type') != 'redirect':
+            return ws  # welcome
+        await ws.close()
+        if 'url' in first:
+            parts = urlsplit(first['url'])._replace(query=parts.query)
+        else:
+            parts = parts._replace(netloc=f"{parts.hostname}:{first['port']}")
+
+
+async def run_client(url, room, recorder, stop_at, rec, binary=False):
+    protocol = server.BINARY_SUBPROTOCOL if binary else server.JSON_SUBPROTOCOL
+    try:
+        async with await connect_room(url, room, protocol) as ws:
+            await ws.send(json.dumps({'type': 'join', 'room': room, 'name': f'load-{room}'}))
+            if recorder:
+                await ws.send(json.dumps({'type': 'start', 'room': room}))
+
+            async def steer():
+                while True:
+                    await asyncio.sleep(random.uniform(0.2, 0.6))
+                    await ws.send(json.dumps({'type': 'dir', 'dir': random.choice(('up', 'down', 'left', 'right'))}))
+
+            async def ping():
+                while True:
+                    await asyncio.sleep(PING_EVERY)
+                    await ws.send(json.dumps({'type': 'ping', 'ts': time.perf_counter()}))
+
+            tasks = [asyncio.create_task(steer())]
+            if recorder:
+                tasks.append(asyncio.create_task(ping()))
+            try:
+                while True:
+                    remaining = stop_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        message = await asyncio.wait_for(ws.recv(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    now = time.monotonic()
+                    rec['bytes'] += len(message)
+                    if not recorder:
+                        continue
+                    # only pongs are decoded; state frames just get timed
+                    if isinstance(message, str) and message.startswith('{"type": "pong"'):
+                        rec['rtts'].append((now, time.perf_counter() - json.loads(message)['ts']))
+                    else:
+                        rec['arrivals'].append(now)
+            finally:
+                for task in tasks:
+                    task.cancel()
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        print(f'client in {room} failed: {e}')
+
+
+async def run_load(url, clients, rooms, duration, warmup=1.0, binary=False, cpu=None):
+    room_names = [f'load-{i}' for i in range(rooms)]
+    recordings = {room: new_recording() for room in room_names}
+    others = new_recording()
+    stop_at = time.monotonic() + warmup + duration
+    tasks = []
+    for i in range(clients):
+        room = room_names[i % rooms]
+        recorder = i < rooms
+        rec = recordings[room] if recorder else others
+        tasks.append(asyncio.create_task(run_client(url, room, recorder, stop_at, rec, binary)))
+    await asyncio.sleep(warmup)
+    cpu_start = cpu() if cpu else None
+    bytes_start = others['bytes'] + sum(r['bytes'] for r in recordings.values())
+    await asyncio.gather(*tasks)
+    total_bytes = others['bytes'] + sum(r['bytes'] for r in recordings.values()) - bytes_start
+    result = summarize(recordings, stop_at - duration, stop_at)
+    result['kb_per_s'] = total_bytes / duration / 1024
+    result['cpu'] = (cpu() - cpu_start) / duration * 100 if cpu else float('nan')
+    return result
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def summarize(recordings, start, end):
+    budget = server.TICK * 1.2
+    gaps_all = []
+    delays = []
+    rtts = []
+    on_tick = 0
+    for rec in recordings.values():
+        times = [t for t in rec['arrivals'] if start <= t <= end]
+        rtts.extend(rtt for t, rtt in rec['rtts'] if start <= t <= end)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        if not gaps:
+            continue
+        gaps_all.extend(gaps)
+        if statistics.median(gaps) <= budget:
+            on_tick += 1
+        # frame k should arrive at phase + k * TICK; the phase is taken from
+        # the earliest frames, so this is delay on top of the best case
+        offsets = [t - k * server.TICK for k, t in enumerate(times)]
+        phase = min(offsets)
+        delays.extend(o - phase for o in offsets)
+    return {
+        'rooms': len(recordings),
+        'rooms_on_tick': on_tick,
+        'jitter_ms': statistics.pstdev(gaps_all) * 1000 if gaps_all else float('nan'),
+        'frame_p50_ms': percentile(delays, 50) * 1000,
+        'frame_p99_ms': percentile(delays, 99) * 1000,
+        'rtt_p50_ms': percentile(rtts, 50) * 1000,
+        'rtt_p99_ms': percentile(rtts, 99) * 1000,
+    }
+
+
+def session_cpu_seconds(sid):
+    # user + system time of every process in the session (Linux /proc)
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[3]) == sid:
+            total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def spawn_server(workers, port):
+    proc = subprocess.Popen(
+        # --leaderboard '': the load clients' scores aren't worth keeping
+        [sys.executable, os.path.join(HERE, 'server.py'), '--no-http', '--workers', str(workers), '--ws-port', str(port),
+         '--leaderboard', ''],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    time.sleep(2.0)
+    return proc
+
+
+def stop_server(proc):
+    # the worker processes share the server's session, so signal all of them
+    os.killpg(proc.pid, signal.SIGTERM)
+    proc.wait()
+
+
+HEADER = (f"{'workers':>8} {'rooms':>6} {'on tick':>8} {'jitter ms':>10} {'frame p50':>10} {'frame p99':>10} "
+          f"{'rtt p50':>8} {'rtt p99':>8} {'KB/s':>9} {'cpu %':>6}")
+
+
+def print_result(label, r):
+    print(f"{label:>8} {r['rooms']:>6} {r['rooms_on_tick']:>8} {r['jitter_ms']:>10.1f} {r['frame_p50_ms']:>10.1f} "
+          f"{r['frame_p99_ms']:>10.1f} {r['rtt_p50_ms']:>8.1f} {r['rtt_p99_ms']:>8.1f} {r['kb_per_s']:>9.1f} {r['cpu']:>6.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='server to load, e.g. ws://localhost:6789 (default: spawn one per --workers)')
+    parser.add_argument('--workers', default='1', help='comma separated worker counts to compare, e.g. 1,2,4')
+    parser.add_argument('--port', type=int, default=6801, help='first port for spawned servers')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=40)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds measured per run')
+    parser.add_argument('--binary', action='store_true', help='negotiate snake.bin.v2 frames')
+    args = parser.parse_args(argv)
+
+    print(HEADER)
+    if args.url:
+        result = asyncio.run(run_load(args.url, args.clients, args.rooms, args.duration, binary=args.binary))
+        print_result('external', result)
+        return
+    for i, workers in enumerate(int(w) for w in args.workers.split(',')):
+        # a fresh port per run: the last run's sockets may still be in TIME_WAIT
+        port = args.port + i
+        proc = spawn_server(workers, port)
+        try:
+            result = asyncio.run(run_load(f'ws://127.0.0.1:{port}', args.clients, args.rooms, args.duration,
+                                          binary=args.binary, cpu=lambda: session_cpu_seconds(proc.pid)))
+        finally:
+            stop_server(proc)
+        print_result(str(workers), result)
+
+
+if __name__ == '__main__':
+    main()
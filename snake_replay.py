@@ -0,0 +1,193 @@
+"""Headless replay of a room's match log from server.py.
+
+Every room keeps an append-only log of what changed its current match
+(joins, leaves, starts, the turn each snake took on each tick) plus its rng
+seeds;
+see the match log comment in server.py. This re-runs that log through the
+server's own tick_room() with no sockets and no sleeping, checks the
+LOG_CHECK digests along the way, and reports how fast it went, which makes
+it a CPU benchmark of the tick logic as well:
+
+    curl -o lobby.snklog http://localhost:5000/api/rooms/lobby/log
+    python snake_replay.py lobby.snklog
+
+A synthetic match can be recorded without a server, then replayed:
+
+    python snake_replay.py --record demo.snklog --players 50 --ticks 5000 --grid 120x80
+    python snake_replay.py demo.snklog --repeat 5
+"""
+import argparse
+import random
+import struct
+import sys
+import time
+from collections import deque
+
+import server
+
+HEADER = struct.Struct('!4sBQHH')
+RECORD = struct.Struct('!IBH')
+
+
+def read_str(data, pos):
+    size = data[pos]
+    return data[pos + 1:pos + 1 + size].decode('utf-8'), pos + 1 + size
+
+
+def read_log(data):
+    magic, version, seed, w, h = HEADER.unpack_from(data)
+    if magic != server.LOG_MAGIC or version != server.LOG_VERSION:
+        raise ValueError('not a snake match log (or a different version)')
+    header = {'seed': seed, 'w': w, 'h': h}
+    records = []
+    pos = HEADER.size
+    while pos < len(data):
+        tick, op, number = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        fields = {}
+        if op == server.LOG_JOIN:
+            dx, dy, alive, score = struct.unpack_from('!bbBI', data, pos)
+            pos += 7
+            pid, pos = read_str(data, pos)
+            name, pos = read_str(data, pos)
+            (count,) = struct.unpack_from('!H', data, pos)
+            cells = struct.unpack_from(f'!{count}I', data, pos + 2)
+            pos += 2 + 4 * count
+            fields = {'dir': [dx, dy], 'alive': bool(alive), 'score': score, 'pid': pid, 'name': name, 'cells': cells}
+        elif op == server.LOG_START:
+            interval_ms, seed, w, h = struct.unpack_from('!HQHH', data, pos)
+            pos += 14
+            fields = {'interval': interval_ms / 1000.0, 'seed': seed, 'size': (w, h)}
+        elif op == server.LOG_DIR:
+            fields = {'dir': server.DIRECTION_LIST[data[pos]]}
+            pos += 1
+        elif op == server.LOG_CHECK:
+            (fields['digest'],) = struct.unpack_from('!I', data, pos)
+            pos += 4
+        elif op not in (server.LOG_LEAVE, server.LOG_END):
+            raise ValueError(f'unknown record {op} at byte {pos - RECORD.size}')
+        records.append((tick, op, number, fields))
+    return header, records
+
+
+def new_player(pid, name, room_name, body):
+    return {
+        'id': pid,
+        'name': name,
+        'body': body,
+        'dir': [1, 0],
+        'inputs': deque(maxlen=server.INPUT_QUEUE),
+        'alive': True,
+        'score': 0,
+        'color': '#66d9e8',
+        'room': room_name,
+    }
+
+
+def replay(data, room_name='replay'):
+    header, records = read_log(data)
+    server.players.clear()
+    server.rooms.clear()
+    room_info = server.rooms[room_name] = server.new_room(header['seed'], header['w'], header['h'])
+    pids = {}
+    result = {'ticks': 0, 'checks': 0, 'mismatch_at': None, 'interval': server.TICK, 'elapsed': 0.0}
+    # a match's log starts at whatever tick the room had reached
+    first_tick = records[0][0] if records else 0
+    room_info['tick'] = first_tick
+    t0 = time.perf_counter()
+    for tick, op, number, fields in records:
+        # records logged at tick N come before tick N + 1 runs, except a
+        # check, which was taken inside that tick
+        target = tick + 1 if op == server.LOG_CHECK else tick
+        while room_info['tick'] < target:
+            server.tick_room(room_name, room_info)
+        if op == server.LOG_JOIN:
+            pid = pids[number] = fields['pid']
+            p = server.players[pid] = new_player(pid, fields['name'], room_name, server.new_body(fields['cells']))
+            p.update(dir=fields['dir'], alive=fields['alive'], score=fields['score'])
+            server.enter_room(pid, room_name)
+        elif op == server.LOG_LEAVE:
+            server.leave_room(pids[number])
+            server.players.pop(pids[number], None)
+        elif op == server.LOG_START:
+            result['interval'] = fields['interval']
+            room_info['interval'] = fields['interval']
+            server.start_room(room_info, fields['seed'], fields['size'])
+        elif op == server.LOG_DIR:
+            server.players[pids[number]]['inputs'].append(fields['dir'])
+        elif op == server.LOG_CHECK:
+            result['checks'] += 1
+            if server.room_digest(room_info) != fields['digest'] and result['mismatch_at'] is None:
+                result['mismatch_at'] = tick
+        elif op == server.LOG_END:
+            break
+    result['elapsed'] = time.perf_counter() - t0
+    result['ticks'] = room_info['tick'] - first_tick
+    result['digest'] = server.room_digest(room_info)
+    return result
+
+
+def record_match(players, ticks, seed, size=None, room_name='record'):
+    # bots that turn at random; their turns end up in the log like anyone's
+    bots = random.Random(seed)
+    server.players.clear()
+    server.rooms.clear()
+    room_info = server.rooms[room_name] = server.new_room(seed, *(size or ()))
+    for i in range(players):
+        pid = f'bot-{i}'
+        server.players[pid] = new_player(pid, pid, room_name, server.spawn_body(room_info))
+        server.enter_room(pid, room_name)
+    server.start_room(room_info, seed)
+    for _ in range(ticks):
+        for p in room_info['members'].values():
+            if bots.random() < 0.2:
+                server.queue_input(p, bots.choice(list(server.DIRECTIONS)))
+        server.tick_room(room_name, room_info)
+        # keep the match going without restarting it, which would start a
+        # new log: a crashed bot leaves and joins again somewhere else
+        for pid, p in list(room_info['members'].items()):
+            if not p['alive']:
+                server.leave_room(pid)
+                server.players[pid] = new_player(pid, pid, room_name, server.spawn_body(room_info, bots))
+                server.enter_room(pid, room_name)
+    return server.room_log(room_info)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('log', nargs='?', help='match log to replay')
+    parser.add_argument('--record', metavar='PATH', help='record a synthetic bot match to PATH first')
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--ticks', type=int, default=2000)
+    parser.add_argument('--grid', default=f'{server.GRID_W}x{server.GRID_H}', help='board size for --record, e.g. 200x200')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='replay this many times and report the fastest')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        size = tuple(int(n) for n in args.grid.lower().split('x'))
+        data = record_match(args.players, args.ticks, args.seed, size)
+        with open(args.record, 'wb') as f:
+            f.write(data)
+        print(f'recorded {args.ticks} ticks of {args.players} bots to {args.record} ({len(data)} bytes)')
+    path = args.log or args.record
+    if not path:
+        parser.error('give a log to replay or --record one')
+    with open(path, 'rb') as f:
+        data = f.read()
+    runs = [replay(data) for _ in range(args.repeat)]
+    best = min(runs, key=lambda r: r['elapsed'])
+    if len({r['digest'] for r in runs}) > 1:
+        print('replays disagree with each other')
+    ticks_per_s = best['ticks'] / best['elapsed'] if best['elapsed'] else float('inf')
+    print(f"{best['ticks']} ticks in {best['elapsed'] * 1000:.1f} ms: {ticks_per_s:.0f} ticks/s, "
+          f"{ticks_per_s * best['interval']:.0f}x real time at {best['interval'] * 1000:.0f} ms/tick")
+    if best['mismatch_at'] is not None:
+        print(f"diverged from the recording at tick {best['mismatch_at']} ({best['checks']} checks)")
+        return 1
+    print(f"{best['checks']} checks matched, final digest {best['digest']:08x}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())